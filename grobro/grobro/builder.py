@@ -1,14 +1,13 @@
 import crc
 import struct
+from grobro.grobro.parser import unscramble
 
-crc16 = crc.Calculator(crc.Crc16.MODBUS)
+crc16 = crc.Calculator(crc.Crc16.MODBUS, optimized=True)
 
 
 def scramble(pkt: bytes) -> bytes:
-    mask = b"Growatt"
-    out = bytearray(pkt[:8])
-    out += bytes(b ^ mask[i % len(mask)] for i, b in enumerate(pkt[8:]))
-    return bytes(out)
+    # XOR with the mask is its own inverse
+    return unscramble(pkt)
 
 
 def append_crc(pkt: bytes) -> bytes:
@@ -16,9 +15,13 @@ def append_crc(pkt: bytes) -> bytes:
     return pkt + struct.pack("!H", csum)
 
 
+# printable ascii stays, everything else is shown as "."
+HEXDUMP_ASCII = bytes(b if 32 <= b <= 126 else 0x2E for b in range(256))
+
+
 def hexdump(data: bytes, width: int = 16) -> None:
     for i in range(0, len(data), width):
         chunk = data[i : i + width]
-        hex_part = " ".join(f"{b:02X}" for b in chunk)
-        asc_part = "".join(chr(b) if 32 <= b <= 126 else "." for b in chunk)
+        hex_part = chunk.hex(" ").upper()
+        asc_part = chunk.translate(HEXDUMP_ASCII).decode("ascii")
         print(f"{i:08X}  {hex_part:<{width * 3}} |{asc_part}|")
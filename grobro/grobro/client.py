@@ -8,6 +8,10 @@ import os
 import struct
 import logging
 import ssl
+import time
+import queue
+import functools
+from threading import Lock, Thread
 from typing import Callable
 
 
@@ -22,6 +26,7 @@ from grobro.grobro.builder import scramble
 from grobro.model.modbus_function import GrowattModbusFunctionSingle
 from grobro.model.modbus_message import GrowattModbusFunction
 from grobro.model.modbus_message import GrowattModbusMessage
+from grobro.model.modbus_message import MODBUS_FUNCTIONS
 from grobro.model.mqtt_config import MQTTConfig
 from grobro.model.growatt_registers import GrowattRegisterDataType
 from grobro.model.growatt_registers import GrowattRegisterDataTypes
@@ -29,7 +34,7 @@ from grobro.model.growatt_registers import GrowattRegisterEnumTypes
 from grobro.model.growatt_registers import HomeAssistantHoldingRegisterInput
 from grobro.model.growatt_registers import HomeAssistantHoldingRegisterValue
 from grobro.model.growatt_registers import HomeAssistantInputRegister
-from grobro.model.growatt_registers import KNOWN_NEO_REGISTERS, KNOWN_NOAH_REGISTERS, KNOWN_NEXA_REGISTERS
+from grobro.model.growatt_registers import get_known_registers
 
 
 LOG = logging.getLogger(__name__)
@@ -37,19 +42,25 @@ HA_BASE_TOPIC = os.getenv("HA_BASE_TOPIC", "homeassistant")
 
 # Updated growatt cloud forwarding config
 GROWATT_CLOUD = os.getenv("GROWATT_CLOUD", "false")
-if GROWATT_CLOUD.lower() == "true":
-    GROWATT_CLOUD_ENABLED = True
-    GROWATT_CLOUD_FILTER = set()
-elif GROWATT_CLOUD:
-    GROWATT_CLOUD_ENABLED = True
-    GROWATT_CLOUD_FILTER = set(map(str.strip, GROWATT_CLOUD.split(",")))
+GROWATT_CLOUD_ALL = GROWATT_CLOUD.lower() == "true"
+if GROWATT_CLOUD_ALL or GROWATT_CLOUD.lower() in ("", "false"):
+    GROWATT_CLOUD_FILTER = frozenset()
 else:
-    GROWATT_CLOUD_ENABLED = False
-    GROWATT_CLOUD_FILTER = set()
+    GROWATT_CLOUD_FILTER = frozenset(map(str.strip, GROWATT_CLOUD.split(",")))
+GROWATT_CLOUD_ENABLED = GROWATT_CLOUD_ALL or bool(GROWATT_CLOUD_FILTER)
 
 DUMP_MESSAGES = os.getenv("DUMP_MESSAGES", "false").lower() == "true"
 DUMP_DIR = os.getenv("DUMP_DIR", "/dump")
 
+# Origins of messages which were forwarded by grobro itself
+FORWARDED_FOR = frozenset({"ha", "growatt"})
+
+READ_SINGLE_REGISTER = GrowattModbusFunction.READ_SINGLE_REGISTER
+READ_INPUT_REGISTER = GrowattModbusFunction.READ_INPUT_REGISTER
+
+# NOAH=387 NEO=340,341
+CONFIG_MSG_TYPES = frozenset({387, 340, 341})
+
 # Property to flag messages forwarded from growatt cloud
 MQTT_PROP_FORWARD_GROWATT = mqtt.Properties(mqtt.PacketTypes.PUBLISH)
 MQTT_PROP_FORWARD_GROWATT.UserProperty = [("forwarded-for", "growatt")]
@@ -70,9 +81,12 @@ class Client:
 
     _client: mqtt.Client
     _forward_mqtt_config: model.MQTTConfig
-    _forward_clients = {}
+    _forward_clients: dict[str, mqtt.Client]
+    _forward_clients_lock: Lock
 
     def __init__(self, grobro_mqtt: MQTTConfig, forward_mqtt: MQTTConfig):
+        self._forward_clients = {}
+        self._forward_clients_lock = Lock()
         LOG.info(
             f"Connecting to GroBro broker at '{grobro_mqtt.host}:{grobro_mqtt.port}'"
         )
@@ -99,7 +113,9 @@ class Client:
         LOG.debug("GroBro: Stop")
         self._client.loop_stop()
         self._client.disconnect()
-        for key, client in self._forward_clients.items():
+        with self._forward_clients_lock:
+            forward_clients = list(self._forward_clients.values())
+        for client in forward_clients:
             client.loop_stop()
             client.disconnect()
 
@@ -122,86 +138,93 @@ class Client:
     def __on_message(self, client, userdata, msg: MQTTMessage):
         # check for forwarded messages and ignore them
         forwarded_for = get_property(msg, "forwarded-for")
-        if forwarded_for and forwarded_for in ["ha", "growatt"]:
+        if forwarded_for in FORWARDED_FOR:
             LOG.debug("Message forwarded from %s. Skipping...", forwarded_for)
             return
 
-        file = get_property(msg, "file")
-        LOG.debug(f"Received message (%s): %s: %s", file, msg.topic, msg.payload)
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            file = get_property(msg, "file")
+            LOG.debug("Received message (%s): %s: %s", file, msg.topic, msg.payload)
         if DUMP_MESSAGES:
             dump_message_binary(msg.topic, msg.payload)
         try:
             device_id = msg.topic.split("/")[-1]
-            if GROWATT_CLOUD_ENABLED:
-                if GROWATT_CLOUD == "true" or device_id in GROWATT_CLOUD_FILTER:
-                    forward_client = self.__connect_to_growatt_server(device_id)
-                    forward_client.publish(
-                        msg.topic,
-                        payload=msg.payload,
-                        qos=msg.qos,
-                        retain=msg.retain,
-                    )
+            if is_cloud_forwarded(device_id):
+                forward_client = self.__connect_to_growatt_server(device_id)
+                forward_client.publish(
+                    msg.topic,
+                    payload=msg.payload,
+                    qos=msg.qos,
+                    retain=msg.retain,
+                )
 
-            unscrambled = parser.unscramble(msg.payload)
-            LOG.debug(f"Received: %s %s", msg.topic, unscrambled.hex(" "))
+            # The 8 byte header is not scrambled, so unknown messages
+            # can be dropped before unscrambling the payload.
+            msg_type = struct.unpack_from(">H", msg.payload, 4)[0]
+            function = msg.payload[7]
+            if function not in MODBUS_FUNCTIONS and msg_type not in CONFIG_MSG_TYPES:
+                if debug:
+                    unscrambled = parser.unscramble(msg.payload)
+                    LOG.debug("Unknown msg_type %s: %s", msg_type, unscrambled.hex())
+                return
 
-            modbus_message = GrowattModbusMessage.parse_grobro(unscrambled)
-            LOG.debug("Received modbus message: %s", modbus_message)
+            unscrambled = parser.unscramble(msg.payload)
+            if debug:
+                LOG.debug("Received: %s %s", msg.topic, unscrambled.hex(" "))
+
+            # config messages carry no modbus function, don't parse them twice
+            modbus_message = None
+            if function in MODBUS_FUNCTIONS:
+                modbus_message = GrowattModbusMessage.parse_grobro(unscrambled)
+                LOG.debug("Received modbus message: %s", modbus_message)
             if modbus_message:
-                known_registers = None
-                if device_id.startswith("QMN"):
-                    known_registers = KNOWN_NEO_REGISTERS
-                elif device_id.startswith("0PVP"):
-                    known_registers = KNOWN_NOAH_REGISTERS
-                elif device_id.startswith("0HVR"):
-                    known_registers = KNOWN_NEXA_REGISTERS
+                known_registers = get_known_registers(device_id)
                 if not known_registers:
                     LOG.info("Modbus message from unknown device type: %s", device_id)
                     return
 
-                if (
-                    modbus_message.function
-                    == GrowattModbusFunction.READ_SINGLE_REGISTER
-                ):
+                if function == READ_SINGLE_REGISTER:
                     state = HomeAssistantHoldingRegisterInput(device_id=device_id)
                     
-                    for name, register in known_registers.holding_registers.items():
-                        data_raw = modbus_message.get_data(register.growatt.position)
-                        value = register.growatt.data.parse(data_raw)
+                    for (
+                        name,
+                        position,
+                        parse,
+                        ha_register,
+                    ) in known_registers.holding_register_table:
+                        value = parse(modbus_message.get_data(position))
                         if value is None:
                             continue
-                        if register.homeassistant.type=="switch":
-                            value = "ON" if value==1 else "OFF"
+                        if ha_register.type == "switch":
+                            value = "ON" if value == 1 else "OFF"
                         state.payload.append(
                             HomeAssistantHoldingRegisterValue(
                                 name=name,
                                 value=value,
-                                register=register.homeassistant,
+                                register=ha_register,
                             )
                         )
                     self.on_holding_register_input(state)
 
-                if modbus_message.function == GrowattModbusFunction.READ_INPUT_REGISTER:
+                elif function == READ_INPUT_REGISTER:
                     state = HomeAssistantInputRegister(device_id=device_id)
                     
-                    for name, register in known_registers.input_registers.items():
-                        data_raw = modbus_message.get_data(register.growatt.position)
-                        data_type = register.growatt.data
-                        value = register.growatt.data.parse(data_raw)
-                        # TODO: this is a workaround for broken messages sent by neo inverters at night.
-                        # They emmit state updates with incredible high wattage, which spoils HA statistics.
-                        # Assuming no one runs a balkony plant with more than a million peak wattage, we drop such messages.
-                        if name == "Ppv" and value > 1000000:
-                            LOG.debug("Dropping bad payload: %s", device_id)
-                            return
-                        state.payload[name] = value
+                    payload = state.payload
+                    for name, position, parse in known_registers.input_register_table:
+                        payload[name] = parse(modbus_message.get_data(position))
+                    # TODO: this is a workaround for broken messages sent by neo inverters at night.
+                    # They emmit state updates with incredible high wattage, which spoils HA statistics.
+                    # Assuming no one runs a balkony plant with more than a million peak wattage, we drop such messages.
+                    ppv = payload.get("Ppv")
+                    if ppv is not None and ppv > 1000000:
+                        LOG.debug("Dropping bad payload: %s", device_id)
+                        return
                     self.on_input_register(state)
                     return
 
                 return
 
-            msg_type = struct.unpack_from(">H", unscrambled, 4)[0]
-
             # NOAH: MSG-TYPE 37 is response when setting a register was succeful
             # TODO impmlement a proper response handling
             #example hex: 00 01 00 07 00 25 01 06 30 50 56 50 46 24 6a 52 32 31 42 54 30 30 32 52 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 fc 00 00 14 8c af
@@ -209,8 +232,7 @@ class Client:
             # NOAH: MSG-TYPE 831 looks like published Holding Register??
             ## Example Hex: 00 01 00 07 03 3f 01 03 30 50 56 50 46 24 6a 52 32 31 42 54 30 30 32 52 00 00 00 00 00 00 00 00 00 00 00 00 00 00 30 50 56 50 46 24 6a 52 32 31 42 54 30 30 32 52 00 00 00 00 00 00 00 00 00 00 00 00 00 00 49 06 14 0f 20 01 03 00 00 00 7c 00 64 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 75 58 00 00 00 19 00 06 00 14 00 0f 00 20 00 01 00 00 00 00 00 00 00 00 00 00 00 31 50 42 46 55 00 00 00 00 00 00 32 31 32 30 31 33 32 31 31 30 31 30 32 31 33 30 30 36 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 7d 00 f9 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 30 50 56 50 46 24 6a 52 32 31 42 54 30 30 32 52 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 fa 01 76 00 64 00 03 00 14 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 00 00 00 00 00 00 00 c8 00 00 03 20 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 5c 83
 
-            # NOAH=387 NEO=340,341
-            if msg_type in (387, 340, 341):
+            if msg_type in CONFIG_MSG_TYPES:
                 # Config message
                 config_offset = parser.find_config_offset(unscrambled)
                 config = parser.parse_config_type(unscrambled, config_offset)
@@ -218,7 +240,8 @@ class Client:
                 LOG.info(f"Received config message for {device_id}")
                 return
 
-            LOG.debug("Unknown msg_type %s: %s", msg_type, unscrambled.hex())
+            if debug:
+                LOG.debug("Unknown msg_type %s: %s", msg_type, unscrambled.hex())
         except Exception as e:
             LOG.error(f"Processing message: {e}")
 
@@ -227,13 +250,12 @@ class Client:
             dump_message_binary(msg.topic, msg.payload)
         try:
             device_id = msg.topic.split("/")[-1]
-            if not GROWATT_CLOUD_ENABLED:
-                return
-            if GROWATT_CLOUD != "true" and device_id not in GROWATT_CLOUD_FILTER:
-                LOG.debug(
-                    "Dropping Growatt message for device %s not in GROWATT_CLOUD filter",
-                    device_id,
-                )
+            if not is_cloud_forwarded(device_id):
+                if GROWATT_CLOUD_ENABLED:
+                    LOG.debug(
+                        "Dropping Growatt message for device %s not in GROWATT_CLOUD filter",
+                        device_id,
+                    )
                 return
             LOG.debug("Forwarding message from Growatt for client %s", device_id)
             # We need to publish the messages from Growatt on the Topic
@@ -250,29 +272,42 @@ class Client:
 
     # Setup Growatt MQTT broker for forwarding messages
     def __connect_to_growatt_server(self, client_id):
-        if f"forward_client_{client_id}" not in self._forward_clients:
-            LOG.info(
-                "Connecting to Growatt broker at '%s:%s', subscribed to '+/%s'",
-                self._forward_mqtt_config.host,
-                self._forward_mqtt_config.port,
-                client_id,
-            )
-            client = mqtt.Client(
-                client_id=client_id,
-                callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
-            )
-            client.tls_set(cert_reqs=ssl.CERT_NONE)
-            client.tls_insecure_set(True)
-            client.on_message = self.__on_message_forward_client
-            client.connect(
-                self._forward_mqtt_config.host,
-                self._forward_mqtt_config.port,
-                60,
-            )
-            client.subscribe(f"+/{client_id}")
-            client.loop_start()
-            self._forward_clients[f"forward_client_{client_id}"] = client
-        return self._forward_clients[f"forward_client_{client_id}"]
+        client = self._forward_clients.get(client_id)
+        if client is not None:
+            return client
+        with self._forward_clients_lock:
+            client = self._forward_clients.get(client_id)
+            if client is None:
+                LOG.info(
+                    "Connecting to Growatt broker at '%s:%s', subscribed to '+/%s'",
+                    self._forward_mqtt_config.host,
+                    self._forward_mqtt_config.port,
+                    client_id,
+                )
+                client = mqtt.Client(
+                    client_id=client_id,
+                    callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+                    userdata=client_id,
+                )
+                client.tls_set(cert_reqs=ssl.CERT_NONE)
+                client.tls_insecure_set(True)
+                client.on_connect = self.__on_connect_forward_client
+                client.on_message = self.__on_message_forward_client
+                client.connect(
+                    self._forward_mqtt_config.host,
+                    self._forward_mqtt_config.port,
+                    60,
+                )
+                client.loop_start()
+                self._forward_clients[client_id] = client
+            return client
+
+    # (Re-)subscribe to messages for the device on every (re-)connect
+    def __on_connect_forward_client(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            LOG.warning("Connecting to Growatt broker for %s failed: %s", userdata, reason_code)
+            return
+        client.subscribe(f"+/{userdata}")
 
 
 # Ensure that the dump directory exists
@@ -281,27 +316,49 @@ if DUMP_MESSAGES and not os.path.exists(DUMP_DIR):
     LOG.info(f"Dump directory created: {DUMP_DIR}")
 
 
+# Messages to be dumped, written to disk by a background thread
+# Bounded, so a stalled disk drops dumps instead of growing memory without limit
+_dump_queue: queue.Queue = queue.Queue(maxsize=10000)
+
+
 def dump_message_binary(topic, payload):
     try:
-        # Build path following topic structure
-        topic_parts = topic.strip("/").split("/")
-        dir_path = os.path.join(DUMP_DIR, *topic_parts)
-        os.makedirs(dir_path, exist_ok=True)
+        _dump_queue.put_nowait((topic, payload, time.time_ns() // 1_000_000))
+    except queue.Full:
+        LOG.warning("Dump queue full, dropping message for topic %s", topic)
+
+
+@functools.lru_cache(maxsize=None)
+def _dump_dir(topic) -> str:
+    # Build path following topic structure
+    topic_parts = topic.strip("/").split("/")
+    dir_path = os.path.join(DUMP_DIR, *topic_parts)
+    os.makedirs(dir_path, exist_ok=True)
+    return dir_path
+
+
+def _dump_writer():
+    while True:
+        topic, payload, timestamp = _dump_queue.get()
+        try:
+            # Write each message to a new file with timestamp
+            file_path = os.path.join(_dump_dir(topic), f"{timestamp}.bin")
+            with open(file_path, "wb") as f:
+                f.write(payload)
+        except Exception as e:
+            LOG.error(f"Failed to dump message for topic {topic}: {e}")
+
 
-        # Write each message to a new file with timestamp
-        import time
+if DUMP_MESSAGES:
+    Thread(target=_dump_writer, daemon=True).start()
 
-        timestamp = int(time.time() * 1000)
-        file_path = os.path.join(dir_path, f"{timestamp}.bin")
 
-        with open(file_path, "wb") as f:
-            f.write(payload)
-    except Exception as e:
-        LOG.error(f"Failed to dump message for topic {topic}: {e}")
+def is_cloud_forwarded(device_id: str) -> bool:
+    return GROWATT_CLOUD_ALL or device_id in GROWATT_CLOUD_FILTER
 
 
 def get_property(msg, prop) -> str:
-    props = msg.properties.json().get("UserProperty", [])
+    props = getattr(msg.properties, "UserProperty", None) or ()
     for key, value in props:
         if key == prop:
             return value
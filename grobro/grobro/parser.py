@@ -2,35 +2,44 @@
 # Automatically descrambles the binary data and decodes it into a structured format.
 
 import struct
+import functools
 import json
 import sys
 import os
 import logging
 import grobro.model as model
-from itertools import cycle
 import importlib.resources as resources
 
 LOG = logging.getLogger(__name__)
 
+SCRAMBLE_MASK = b"Growatt"
 
-def unscramble(decdata: bytes):
+
+@functools.lru_cache(maxsize=64)
+def _scramble_mask(length: int) -> int:
     """
-    Unscrambling algorithm based on XOR with "Growatt" mask
+    The "Growatt" mask repeated to length bytes, as integer.
+    Payload sizes repeat per device and message type, so this is built once per size.
     """
-    ndecdata = len(decdata)
-    mask = "Growatt"
-    hex_mask = ["{:02x}".format(ord(x)) for x in mask]
-    nmask = len(hex_mask)
+    mask = (SCRAMBLE_MASK * (length // len(SCRAMBLE_MASK) + 1))[:length]
+    return int.from_bytes(mask, "big")
+
 
-    unscrambled = bytes(decdata[0:8])  # Preserve the 8-byte header
-    for i, j in zip(range(0, ndecdata - 8), cycle(range(0, nmask))):
-        unscrambled += bytes([decdata[i + 8] ^ int(hex_mask[j], 16)])
+def unscramble(decdata: bytes) -> bytes:
+    """
+    Unscrambling algorithm based on XOR with "Growatt" mask.
+    The payload is XORed as one big integer, which keeps the
+    per-byte loop out of the interpreter.
+    """
+    body = memoryview(decdata)[8:]
+    nbody = len(body)
+    unscrambled = int.from_bytes(body, "big") ^ _scramble_mask(nbody)
 
-    # hexdump(unscrambled)
-    return unscrambled
+    # Preserve the 8-byte header
+    return bytes(decdata[0:8]) + unscrambled.to_bytes(nbody, "big")
 
 
-def parse_config_type(data, offset) -> model.DeviceConfig:
+def parse_config_type(data: bytes, offset: int) -> model.DeviceConfig:
     """
     Parse a configuration message starting at offset as a TLV block
     Each parameter is stored as:
@@ -90,7 +99,8 @@ def parse_config_type(data, offset) -> model.DeviceConfig:
 
         try:
             val = raw_val.decode("ascii").strip("\x00")
-            if any(ord(c) < 32 or ord(c) > 126 for c in val):
+            # ascii is printable exactly in the 32..126 range
+            if not val.isprintable():
                 raise ValueError()
         except Exception:
             val = raw_val.hex()
@@ -105,7 +115,7 @@ def parse_config_type(data, offset) -> model.DeviceConfig:
     return model.DeviceConfig(**config)
 
 
-def find_config_offset(data):
+def find_config_offset(data: bytes) -> int:
     """
     Heuristically search for the start of the TLV configuration block by
     looking for a repeating pattern of a 2-byte key followed by a 2-byte length.
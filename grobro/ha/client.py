@@ -1,13 +1,17 @@
 from grobro.model.growatt_registers import HomeAssistantInputRegister
-from grobro.model.growatt_registers import KNOWN_NEO_REGISTERS, KNOWN_NOAH_REGISTERS, KNOWN_NEXA_REGISTERS
+from grobro.model.growatt_registers import get_known_registers
 import os
+import glob
 import struct
 import ssl
-import json
+import time
 import logging
+import functools
+import orjson
 import grobro.model as model
 import importlib.resources as resources
-from threading import Timer
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
 from typing import Callable
 
 import paho.mqtt.client as mqtt
@@ -21,21 +25,62 @@ from grobro.model.modbus_function import GrowattModbusFunctionMultiple
 HA_BASE_TOPIC = os.getenv("HA_BASE_TOPIC", "homeassistant")
 DEVICE_TIMEOUT = int(os.getenv("DEVICE_TIMEOUT", 0))
 MAX_SLOTS = int(os.getenv("MAX_SLOTS", "1"))
+# Seconds stop() waits for queued publishes to be handed to the MQTT client
+PUBLISH_DRAIN_TIMEOUT = 5
 LOG = logging.getLogger(__name__)
 
+MIGRATE_DISCOVERY_PAYLOAD = orjson.dumps({"migrate_discovery": True})
+AVAILABILITY_ONLINE = b"online"
+AVAILABILITY_OFFLINE = b"offline"
+COMMAND_TYPES = frozenset({"number", "button", "switch"})
+DEVICE_TYPE_MODELS = {
+    "55": "NEO-series",
+    "72": "NEXA-series",
+    "61": "NOAH-series",
+}
+
+
+# Slot registers above MAX_SLOTS are neither published nor read.
+@functools.lru_cache(maxsize=None)
+def is_slot_enabled(register_name: str) -> bool:
+    if not register_name.startswith("slot"):
+        return True
+    try:
+        return int(register_name[4]) <= MAX_SLOTS
+    except ValueError:
+        return False
+
 
 class Client:
     on_command: Optional[Callable[GrowattModbusFunctionSingle, None]]
 
     _client: mqtt.Client
-    _config_cache: dict[str, model.DeviceConfig] = {}
-    _discovery_cache: list[str] = []
-    _device_timers: dict[str, Timer] = {}
+    _config_cache: dict[str, model.DeviceConfig]
+    _discovery_cache: set[str]
+    _discovery_payload_cache: dict[str, bytes]
+    _migrated_devices: set[str]
+    _device_topics: dict[str, str]
+    _last_seen: dict[str, float]
+    _last_seen_lock: Lock
+    _stopped: Event
+    _publish_queue: SimpleQueue
+    _publish_thread: Optional[Thread]
 
     def __init__(
         self,
         mqtt_config: model.MQTTConfig,
     ):
+        self._config_cache = {}
+        self._discovery_cache = set()
+        self._discovery_payload_cache = {}
+        self._migrated_devices = set()
+        self._device_topics = {}
+        self._last_seen = {}
+        self._last_seen_lock = Lock()
+        self._stopped = Event()
+        self._publish_queue = SimpleQueue()
+        self._publish_thread = None
+
         # Setup target MQTT client for publishing
         LOG.info(f"Connecting to HA broker at '{mqtt_config.host}:{mqtt_config.port}'")
         self._client = mqtt.Client(
@@ -48,43 +93,49 @@ class Client:
             self._client.tls_insecure_set(True)
         self._client.connect(mqtt_config.host, mqtt_config.port, 60)
 
-        for cmd_type in ["number", "button", "switch"]:
+        for cmd_type in COMMAND_TYPES:
             for action in ["set", "read"]:
                 topic = f"{HA_BASE_TOPIC}/{cmd_type}/grobro/+/+/{action}"
                 self._client.subscribe(topic)
         self._client.on_message = self.__on_message
 
-        for fname in os.listdir("."):
-            if fname.startswith("config_") and fname.endswith(".json"):
-                config = model.DeviceConfig.from_file(fname)
-                if config:
-                    self._config_cache[config.device_id] = config
-
-        self._discovery_payload_cache: dict[str, str] = {}
+        for fname in glob.iglob("config_*.json"):
+            config = model.DeviceConfig.from_file(fname)
+            if config:
+                # key by file name, which is what lookups fall back to
+                device_id = fname.removeprefix("config_").removesuffix(".json")
+                self._config_cache[device_id] = config
 
     def start(self):
         self._client.loop_start()
+        self._publish_thread = Thread(target=self.__publish_worker, daemon=True)
+        self._publish_thread.start()
+        if DEVICE_TIMEOUT > 0:
+            Thread(target=self.__watch_device_timeouts, daemon=True).start()
 
     def stop(self):
+        self._stopped.set()
+        self._publish_queue.put(None)
+        # let the worker hand over what is still queued before the loop stops
+        if self._publish_thread is not None:
+            self._publish_thread.join(timeout=PUBLISH_DRAIN_TIMEOUT)
         self._client.loop_stop()
         self._client.disconnect()
 
     def set_config(self, config: model.DeviceConfig):
-        device_id = config.serial_number
-        config_path = f"config_{config.device_id}.json"
-        existing_config = model.DeviceConfig.from_file(config_path)
-        if existing_config is None or existing_config != config:
-            LOG.info(f"Saving updated config for {config.device_id}")
-            config.to_file(config_path)
+        device_id = config.device_id
+        # the cache mirrors the config files, so there is no need to read them back
+        if self._config_cache.get(device_id) == config:
+            LOG.debug(f"No config change for {device_id}")
         else:
-            LOG.debug(f"No config change for {config.device_id}")
-        self._config_cache[config.device_id] = config
+            LOG.info(f"Saving updated config for {device_id}")
+            config.to_file(f"config_{device_id}.json")
+            self._config_cache[device_id] = config
+            self._discovery_cache.discard(device_id)
 
-        if device_id in self._discovery_cache:
-            self._discovery_cache.remove(device_id)
+        # announce entities for unchanged configs too, this is deduplicated by the discovery cache
         self.__publish_device_discovery(device_id)
 
-
     def publish_input_register(self, state: HomeAssistantInputRegister):
         LOG.debug("HA: publish: %s", state)
         # publish discovery
@@ -92,11 +143,12 @@ class Client:
         # update availability
         self.__publish_availability(state.device_id, True)
         if DEVICE_TIMEOUT > 0:
-            self.__reset_device_timer(state.device_id)
+            with self._last_seen_lock:
+                self._last_seen[state.device_id] = time.monotonic()
 
         # update state
-        topic = f"{HA_BASE_TOPIC}/grobro/{state.device_id}/state"
-        self._client.publish(topic, json.dumps(state.payload), retain=False)
+        topic = f"{self.__device_topic(state.device_id)}/state"
+        self.__publish(topic, orjson.dumps(state.payload), retain=False)
 
     def publish_holding_register_input(
         self, ha_input: HomeAssistantHoldingRegisterInput
@@ -105,18 +157,14 @@ class Client:
             LOG.debug("HA: publish: %s", ha_input)
             for value in ha_input.payload:
                 topic = f"{HA_BASE_TOPIC}/{value.register.type}/grobro/{ha_input.device_id}/{value.name}/get"
-                self._client.publish(topic, value.value, retain=False)
+                self.__publish(topic, value.value, retain=False)
         except Exception as e:
             LOG.error(f"HA: publish msg: {e}")
 
     def __on_message(self, client, userdata, msg: mqtt.MQTTMessage):
         parts = msg.topic.removeprefix(f"{HA_BASE_TOPIC}/").split("/")
         cmd_type, device_id, cmd_name, action = None, None, None, None
-        if len(parts) == 5 and parts[0] in ["number"]:
-            cmd_type, _, device_id, cmd_name, action = parts
-        if len(parts) == 5 and parts[0] in ["button"]:
-            cmd_type, _, device_id, cmd_name, action = parts
-        if len(parts) == 5 and parts[0] in ["switch"]:
+        if len(parts) == 5 and parts[0] in COMMAND_TYPES:
             cmd_type, _, device_id, cmd_name, action = parts
 
         LOG.debug(
@@ -127,27 +175,15 @@ class Client:
             device_id,
         )
 
-        known_registers: Optional[GroBroRegisters] = None
-        if device_id.startswith("QMN"):
-            known_registers = KNOWN_NEO_REGISTERS
-        elif device_id.startswith("0PVP"):
-            known_registers = KNOWN_NOAH_REGISTERS
-        elif device_id.startswith("0HVR"):
-            known_registers = KNOWN_NEXA_REGISTERS
+        known_registers = get_known_registers(device_id)
         if not known_registers:
             LOG.info("Unknown device type: %s", device_id)
             return
  
         if cmd_type == "button" and cmd_name == "read_all":
-            for name, register in known_registers.holding_registers.items():
-                if name.startswith("slot"):
-                    try:
-                        slot_num = int(name[4])
-                        if slot_num > MAX_SLOTS:
-                            continue
-                    except ValueError:
-                        continue
-                pos = register.growatt.position
+            for name, pos, _, _ in known_registers.holding_register_table:
+                if not is_slot_enabled(name):
+                    continue
                 self.on_command(
                     GrowattModbusFunctionSingle(
                         device_id=device_id,
@@ -157,8 +193,14 @@ class Client:
                     )
                 )
             return
+
+        register = known_registers.holding_registers.get(cmd_name)
+        if register is None or register.growatt is None:
+            LOG.info("Unknown command %s for device %s", cmd_name, device_id)
+            return
+        pos = register.growatt.position
+
         if cmd_type == "button" and action == "read":
-            pos = known_registers.holding_registers[cmd_name].growatt.position
             self.on_command(
                 GrowattModbusFunctionSingle(
                     device_id=device_id,
@@ -179,7 +221,6 @@ class Client:
             else:
                 parsed_value=int(msg.payload.decode())
 
-            pos = known_registers.holding_registers[cmd_name].growatt.position
             LOG.debug("Setting %s register %s to value %s", cmd_name, pos.register_no, parsed_value)
             self.on_command(
                 GrowattModbusFunctionSingle(
@@ -200,39 +241,58 @@ class Client:
                 )
             )
 
-    # Reset the timeout timer for a device.
-    def __reset_device_timer(self, device_id):
-        def set_device_unavailable(device_id):
-            LOG.warning("Device %s timed out. Mark it as unavailable.", device_id)
-            self.__publish_availability(device_id, False)
-
-        if device_id in self._device_timers:
-            self._device_timers[device_id].cancel()  # Cancel the existing timer
-
-        timer = Timer(
-            DEVICE_TIMEOUT,
-            set_device_unavailable,
-            args=[device_id],
-        )  # Pass function reference and arguments
-        self._device_timers[device_id] = timer
-        timer.start()
+    # Periodically mark devices as unavailable which were not seen within DEVICE_TIMEOUT.
+    def __watch_device_timeouts(self):
+        while not self._stopped.wait(DEVICE_TIMEOUT / 4):
+            deadline = time.monotonic() - DEVICE_TIMEOUT
+            with self._last_seen_lock:
+                timed_out = [
+                    device_id
+                    for device_id, last_seen in self._last_seen.items()
+                    if last_seen < deadline
+                ]
+                for device_id in timed_out:
+                    del self._last_seen[device_id]
+            for device_id in timed_out:
+                LOG.warning("Device %s timed out. Mark it as unavailable.", device_id)
+                self.__publish_availability(device_id, False)
+
+    # Queue a message for the publish worker, keeping the caller's thread free of socket writes.
+    def __publish(self, topic: str, payload, retain: bool):
+        self._publish_queue.put((topic, payload, retain))
+
+    def __publish_worker(self):
+        while True:
+            item = self._publish_queue.get()
+            if item is None:
+                return
+            topic, payload, retain = item
+            try:
+                self._client.publish(topic, payload, retain=retain)
+            except Exception as e:
+                LOG.error(f"HA: publish {topic}: {e}")
+
+    def __device_topic(self, device_id) -> str:
+        topic = self._device_topics.get(device_id)
+        if topic is None:
+            topic = f"{HA_BASE_TOPIC}/grobro/{device_id}"
+            self._device_topics[device_id] = topic
+        return topic
 
     def __publish_availability(self, device_id, online: bool):
         LOG.debug("Set device %s availability: %s", device_id, online)
-        self._client.publish(
-            f"{HA_BASE_TOPIC}/grobro/{device_id}/availability",
-            "online" if online else "offline",
+        self.__publish(
+            f"{self.__device_topic(device_id)}/availability",
+            AVAILABILITY_ONLINE if online else AVAILABILITY_OFFLINE,
             retain=False,
         )
 
     def __publish_device_discovery(self, device_id):
-        known_registers: Optional[GroBroRegisters] = None
-        if device_id.startswith("QMN"):
-            known_registers = KNOWN_NEO_REGISTERS
-        elif device_id.startswith("0PVP"):
-            known_registers = KNOWN_NOAH_REGISTERS
-        elif device_id.startswith("0HVR"):
-            known_registers = KNOWN_NEXA_REGISTERS
+        # discovery only changes with the device config, see set_config
+        if device_id in self._discovery_cache:
+            return
+
+        known_registers = get_known_registers(device_id)
         if not known_registers:
             LOG.info("Unable to publish unknown device type: %s", device_id)
             return
@@ -244,7 +304,7 @@ class Client:
         # prepare discovery payload
         payload = {
             "dev": self.__device_info_from_config(device_id),
-            "avty_t": f"{HA_BASE_TOPIC}/grobro/{device_id}/availability",
+            "avty_t": f"{self.__device_topic(device_id)}/availability",
             "o": {
                 "name": "grobro",
                 "url": "https://github.com/robertzaage/GroBro",
@@ -255,14 +315,8 @@ class Client:
         for cmd_name, cmd in known_registers.holding_registers.items():
             if not cmd.homeassistant.publish:
                 continue
-            
-            if cmd_name.startswith("slot"):
-                try:
-                    slot_num = int(cmd_name[4])
-                    if slot_num > MAX_SLOTS:
-                        continue
-                except ValueError:
-                    continue
+            if not is_slot_enabled(cmd_name):
+                continue
             unique_id = f"grobro_{device_id}_cmd_{cmd_name}"
             cmd_type = cmd.homeassistant.type
             payload["cmps"][unique_id] = {
@@ -270,7 +324,7 @@ class Client:
                 "state_topic": f"{HA_BASE_TOPIC}/{cmd_type}/grobro/{device_id}/{cmd_name}/get",
                 "platform": cmd_type,
                 "unique_id": unique_id,
-                **cmd.homeassistant.dict(exclude_none=True),
+                **cmd.homeassistant.discovery_fields,
             }
 
         payload["cmps"][f"grobro_{device_id}_cmd_read_all"] = {
@@ -287,7 +341,7 @@ class Client:
             payload["cmps"][unique_id] = {
                 "platform": "sensor",
                 "name": state.homeassistant.name,
-                "state_topic": f"{HA_BASE_TOPIC}/grobro/{device_id}/state",
+                "state_topic": f"{self.__device_topic(device_id)}/state",
                 "value_template": f"{{{{ value_json['{state_name}'] }}}}",
                 "unique_id": unique_id,
                 "object_id": f"{device_id}_{state_name}",
@@ -297,64 +351,74 @@ class Client:
                 "icon": state.homeassistant.icon,
             }
 
-        payload_str = json.dumps(payload, sort_keys=True)
+        payload_raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
 
-        if self._discovery_payload_cache.get(device_id) == payload_str:
+        if self._discovery_payload_cache.get(device_id) == payload_raw:
             LOG.debug("Discovery unchanged for %s, skipping", device_id)
-            self._discovery_cache.append(device_id)
+            self._discovery_cache.add(device_id)
             return
 
         LOG.info("Publishing updated discovery for %s", device_id)
-        self._client.publish(topic, "", retain=True)
-        self._client.publish(topic, payload_str, retain=True)
-        self._discovery_payload_cache[device_id] = payload_str
-        self._discovery_cache.append(device_id)
+        self.__publish(topic, "", retain=True)
+        self.__publish(topic, payload_raw, retain=True)
+        self._discovery_payload_cache[device_id] = payload_raw
+        self._discovery_cache.add(device_id)
 
 
     def __migrate_entity_discovery(self, device_id, knwon_registers: GroBroRegisters):
+        # legacy per-entity configs only need to be cleared once per device
+        if device_id in self._migrated_devices:
+            return
+        self._migrated_devices.add(device_id)
+
         old_entities = [
             ("set_wirk", "number"),
         ]
         for e_name, e_type in old_entities:
-            self._client.publish(
+            self.__publish(
                 f"{HA_BASE_TOPIC}/{e_type}/grobro/{device_id}_{e_name}/config",
-                json.dumps({"migrate_discovery": True}),
+                MIGRATE_DISCOVERY_PAYLOAD,
                 retain=True,
             )
         for cmd_name, cmd in knwon_registers.holding_registers.items():
             cmd_type = cmd.homeassistant.type
-            self._client.publish(
+            self.__publish(
                 f"{HA_BASE_TOPIC}/{cmd_type}/grobro/{device_id}_{cmd_name}/config",
-                json.dumps({"migrate_discovery": True}),
+                MIGRATE_DISCOVERY_PAYLOAD,
                 retain=True,
             )
-            self._client.publish(
+            self.__publish(
                 f"{HA_BASE_TOPIC}/{cmd_type}/grobro/{device_id}_{cmd_name}_read/config",
-                json.dumps({"migrate_discovery": True}),
+                MIGRATE_DISCOVERY_PAYLOAD,
                 retain=True,
             )
         for state_name, state in knwon_registers.input_registers.items():
-            self._client.publish(
+            self.__publish(
                 f"{HA_BASE_TOPIC}/sensor/grobro/{device_id}_{state_name}/config",
-                json.dumps({"migrate_discovery": True}),
+                MIGRATE_DISCOVERY_PAYLOAD,
                 retain=True,
             )
 
-    def __device_info_from_config(self, device_id):
+    def __resolve_config(self, device_id) -> model.DeviceConfig:
         # Find matching config
         config = self._config_cache.get(device_id)
+        if config:
+            return config
         config_path = f"config_{device_id}.json"
         # Fallback: try loading from file
-        if not config:
-            config = model.DeviceConfig.from_file(config_path)
-            self._config_cache[device_id] = config
+        config = model.DeviceConfig.from_file(config_path)
+        if config:
             LOG.info(f"Loaded cached config for {device_id} from file (fallback)")
-        # Fallback 2: save minimal config if it was neither in cache nor on disk
-        if not config:
+        else:
+            # Fallback 2: save minimal config if it was neither in cache nor on disk
             config = model.DeviceConfig(serial_number=device_id)
             config.to_file(config_path)
-            self._config_cache[device_id] = config
             LOG.info(f"Saved minimal config for new device: {config}")
+        self._config_cache[device_id] = config
+        return config
+
+    def __device_info_from_config(self, device_id):
+        config = self.__resolve_config(device_id)
 
         device_info = {
             "identifiers": [device_id],
@@ -362,11 +426,7 @@ class Client:
             "manufacturer": "Growatt",
             "serial_number": device_id,
         }
-        known_model_id = {
-            "55": "NEO-series",
-            "72": "NEXA-series",
-            "61": "NOAH-series",
-        }.get(config.device_type)
+        known_model_id = DEVICE_TYPE_MODELS.get(config.device_type)
 
         if known_model_id:
             device_info["model"] = known_model_id
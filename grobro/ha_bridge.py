@@ -8,7 +8,7 @@ and republishes values for Home Assistant auto-discovery.
 import os
 import signal
 import logging
-import time
+import threading
 
 from grobro import model, ha, grobro
 
@@ -52,27 +52,26 @@ class SignalHandler:
     graceful shutdown.
     """
 
-    _caught: bool
+    _stop_event: threading.Event
 
     def __init__(self):
-        self._running = True
+        self._stop_event = threading.Event()
         # Register signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self._handle)
         signal.signal(signal.SIGTERM, self._handle)
 
     def _handle(self, _, __):
         """
-        Handles signal by setting RUNNING to false.
+        Handles signal by setting the stop event.
         """
         LOG.info("Signal received, shutting down...")
-        self._running = False
+        self._stop_event.set()
 
-    @property
-    def caught(self) -> bool:
+    def wait(self):
         """
-        Wether the signal was caught.
+        Blocks until a signal was caught.
         """
-        return self._running
+        self._stop_event.wait()
 
 
 if __name__ == "__main__":
@@ -95,8 +94,7 @@ if __name__ == "__main__":
     grobro_client.start()
 
     try:
-        while signal_handler.caught:
-            time.sleep(0.1)
+        signal_handler.wait()
     finally:
         ha_client.stop()
         grobro_client.stop()
@@ -1,8 +1,7 @@
 from dataclasses import dataclass, asdict
 import logging
-import json
+import orjson
 from typing import Optional
-import os
 from pydantic import BaseModel
 from enum import Enum
 
@@ -51,13 +50,13 @@ class DeviceConfig(BaseModel):
 
     @staticmethod
     def from_file(file_path: str) -> Optional["DeviceConfig"]:
-        if not os.path.exists(file_path):
-            return None
         try:
-            with open(file_path, "r") as f:
-                data = json.load(f)
+            with open(file_path, "rb") as f:
+                data = orjson.loads(f.read())
                 LOG.debug(f"Loaded {data}")
                 return DeviceConfig(**data)
+        except FileNotFoundError:
+            return None
         except Exception as e:
             LOG.error(f"Failed to load config {file_path}: {e}")
             return None
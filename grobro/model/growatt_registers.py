@@ -1,8 +1,8 @@
-from typing import Optional, Union
+from typing import Callable, NamedTuple, Optional, Union
 from enum import Enum
 from pydantic import BaseModel
 import importlib.resources as resources
-import json
+import functools
 import struct
 
 
@@ -20,8 +20,24 @@ class GrowattRegisterEnumTypes(str, Enum):
 
 
 class GrowattRegisterFloatOptions(BaseModel):
-    delta: float = 1
-    multiplier: float = 1
+    delta: float = 1.0
+    multiplier: float = 1.0
+
+    @functools.cached_property
+    def divisor(self) -> Optional[int]:
+        """
+        Whole number divisor equivalent to the multiplier (e.g. 10 for 0.1),
+        if dividing by it gives the same result as the rounded product.
+        Only divisors of 1000 qualify, finer steps need the rounding to 3 places.
+        """
+        if self.multiplier <= 0:
+            return None
+        divisor = round(1 / self.multiplier)
+        if divisor not in (1, 10, 100, 1000) or 1 / divisor != self.multiplier:
+            return None
+        if self.delta != 0 and not (divisor == 1 and self.delta.is_integer()):
+            return None
+        return divisor
 
 
 class GrowattRegisterEnumOptions(BaseModel):
@@ -29,42 +45,94 @@ class GrowattRegisterEnumOptions(BaseModel):
     values: dict[int, str]
 
 
+RegisterValue = Union[str, float, int, None]
+RegisterParser = Callable[[Optional[bytes]], RegisterValue]
+
+
+def _parse_none(data_raw: Optional[bytes]) -> RegisterValue:
+    return None
+
+
+# Unpackers for the raw register values by their size in bytes
+UNPACKERS = {1: struct.Struct("!B"), 2: struct.Struct("!H"), 4: struct.Struct("!I")}
+
+
 class GrowattRegisterDataType(BaseModel):
     data_type: GrowattRegisterDataTypes
     float_options: Optional[GrowattRegisterFloatOptions] = None
     enum_options: Optional[GrowattRegisterEnumOptions] = None
 
-    def parse(self, data_raw: bytes):
-        if not data_raw:
-            return None
-        unpack_type = {1: "!B", 2: "!H", 4: "!I"}[len(data_raw)]
+    def parse(self, data_raw: Optional[bytes]) -> RegisterValue:
+        return self.parser(data_raw)
+
+    @functools.cached_property
+    def parser(self) -> RegisterParser:
+        """
+        Parse function specialized for this data type,
+        so the type and option dispatch happens once per register instead of per value.
+        """
         if self.data_type == GrowattRegisterDataTypes.FLOAT:
             opts = self.float_options
-            value = struct.unpack(unpack_type, data_raw)[0]
-            value *= opts.multiplier
-            value += opts.delta
-            return round(value, 3)
+            divisor, multiplier, delta = opts.divisor, opts.multiplier, opts.delta
+            if divisor:
+
+                def parse_float(data_raw: Optional[bytes]) -> RegisterValue:
+                    if not data_raw:
+                        return None
+                    return UNPACKERS[len(data_raw)].unpack(data_raw)[0] / divisor + delta
+
+            else:
+
+                def parse_float(data_raw: Optional[bytes]) -> RegisterValue:
+                    if not data_raw:
+                        return None
+                    value = UNPACKERS[len(data_raw)].unpack(data_raw)[0]
+                    return round(value * multiplier + delta, 3)
+
+            return parse_float
         elif self.data_type == GrowattRegisterDataTypes.TIME_HHMM:
-            value = struct.unpack(unpack_type, data_raw)[0]
-            h = value // 256
-            m = value % 256
-            return (h * 100) + m
+
+            def parse_time(data_raw: Optional[bytes]) -> RegisterValue:
+                if not data_raw:
+                    return None
+                value = UNPACKERS[len(data_raw)].unpack(data_raw)[0]
+                h = value // 256
+                m = value % 256
+                return (h * 100) + m
+
+            return parse_time
         elif self.data_type == GrowattRegisterDataTypes.INT:
-            value = struct.unpack(unpack_type, data_raw)[0]
-            return value
+
+            def parse_int(data_raw: Optional[bytes]) -> RegisterValue:
+                if not data_raw:
+                    return None
+                return UNPACKERS[len(data_raw)].unpack(data_raw)[0]
+
+            return parse_int
         elif self.data_type == GrowattRegisterDataTypes.ENUM:
             opts = self.enum_options
-            value = struct.unpack(unpack_type, data_raw)[0]
-            if opts.enum_type == GrowattRegisterEnumTypes.BITFIELD:
-                return None  # TODO: implement
-            elif opts.enum_type == GrowattRegisterEnumTypes.INT_MAP:
-                enum_value = opts.values.get(int(value), None)
-                if not enum_value:
-                    return None
-                return value
+            if opts.enum_type == GrowattRegisterEnumTypes.INT_MAP:
+                values = opts.values
+
+                def parse_enum(data_raw: Optional[bytes]) -> RegisterValue:
+                    if not data_raw:
+                        return None
+                    value = UNPACKERS[len(data_raw)].unpack(data_raw)[0]
+                    if not values.get(value):
+                        return None
+                    return value
+
+                return parse_enum
+            # TODO: implement BITFIELD
         elif self.data_type == GrowattRegisterDataTypes.STRING:
-            value = data_raw.decode("ascii", errors="ignore").strip("\x00")
-            return value
+
+            def parse_string(data_raw: Optional[bytes]) -> RegisterValue:
+                if not data_raw:
+                    return None
+                return data_raw.decode("ascii", errors="ignore").strip("\x00")
+
+            return parse_string
+        return _parse_none
 
 
 class GrowattRegisterPosition(BaseModel):
@@ -93,6 +161,13 @@ class HomeAssistantHoldingRegister(BaseModel):
     class Config:
         extra = "forbid"
 
+    @functools.cached_property
+    def discovery_fields(self) -> dict[str, Union[str, int, bool]]:
+        """
+        Device independent part of the discovery component.
+        """
+        return self.dict(exclude_none=True)
+
 
 class HomeassistantInputRegister(BaseModel):
     name: str
@@ -133,17 +208,75 @@ class GroBroRegisters(BaseModel):
     input_registers: dict[str, GroBroInputRegister]
     holding_registers: dict[str, GroBroHoldingRegister]
 
+    @functools.cached_property
+    def input_register_table(self) -> tuple["InputRegisterRow", ...]:
+        """
+        Flat rows of all input registers,
+        so decoding a message does not walk the nested models per register.
+        """
+        return tuple(
+            InputRegisterRow(name, register.growatt.position, register.growatt.data.parser)
+            for name, register in self.input_registers.items()
+        )
+
+    @functools.cached_property
+    def holding_register_table(self) -> tuple["HoldingRegisterRow", ...]:
+        """
+        Flat rows of all holding registers that can be read from the device.
+        """
+        return tuple(
+            HoldingRegisterRow(
+                name,
+                register.growatt.position,
+                register.growatt.data.parser,
+                register.homeassistant,
+            )
+            for name, register in self.holding_registers.items()
+            if register.growatt is not None
+        )
+
+
+class InputRegisterRow(NamedTuple):
+    name: str
+    position: GrowattRegisterPosition
+    parse: RegisterParser
+
+
+class HoldingRegisterRow(NamedTuple):
+    name: str
+    position: GrowattRegisterPosition
+    parse: RegisterParser
+    homeassistant: HomeAssistantHoldingRegister
+
 
 with resources.files(__package__).joinpath("growatt_neo_registers.json").open(
     "rb"
 ) as f:
-    KNOWN_NEO_REGISTERS = GroBroRegisters.parse_obj(json.load(f))
+    KNOWN_NEO_REGISTERS = GroBroRegisters.model_validate_json(f.read())
 with resources.files(__package__).joinpath("growatt_noah_registers.json").open(
     "rb"
 ) as f:
-    KNOWN_NOAH_REGISTERS = GroBroRegisters.parse_obj(json.load(f))
+    KNOWN_NOAH_REGISTERS = GroBroRegisters.model_validate_json(f.read())
 
 with resources.files(__package__).joinpath("growatt_nexa_registers.json").open(
     "rb"
 ) as f:
-    KNOWN_NEXA_REGISTERS = GroBroRegisters.parse_obj(json.load(f))
+    KNOWN_NEXA_REGISTERS = GroBroRegisters.model_validate_json(f.read())
+
+KNOWN_REGISTERS_BY_PREFIX = {
+    "QMN": KNOWN_NEO_REGISTERS,
+    "0PVP": KNOWN_NOAH_REGISTERS,
+    "0HVR": KNOWN_NEXA_REGISTERS,
+}
+
+# Build the decode tables with the catalogs, not on the first message of a device.
+for _registers in KNOWN_REGISTERS_BY_PREFIX.values():
+    _registers.input_register_table
+    _registers.holding_register_table
+
+
+def get_known_registers(device_id: str) -> Optional[GroBroRegisters]:
+    for prefix, registers in KNOWN_REGISTERS_BY_PREFIX.items():
+        if device_id.startswith(prefix):
+            return registers
+    return None
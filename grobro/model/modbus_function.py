@@ -1,4 +1,5 @@
 from grobro.model.modbus_message import GrowattModbusFunction
+from grobro.model.modbus_message import encode_device_id
 import struct
 from pydantic import BaseModel
 from enum import Enum
@@ -6,6 +7,7 @@ from pylint.checkers.base import register
 from typing import Optional
 
 MODBUS_COMMAND_STRUCT = ">HHHBB30sHH"
+MODBUS_COMMAND = struct.Struct(MODBUS_COMMAND_STRUCT)
 
 
 class GrowattModbusFunctionMultiple(BaseModel):
@@ -42,28 +44,28 @@ class GrowattModbusFunctionMultiple(BaseModel):
             device_id_raw,
             start,
             end,
-        ) = struct.unpack(MODBUS_COMMAND_STRUCT, buffer[0:42])
+        ) = MODBUS_COMMAND.unpack_from(buffer)
 
         device_id = device_id_raw.decode("ascii", errors="ignore").strip("\x00")
-        values = buffer[42:]
+        # msg_len covers the message body after the 6 header bytes that precede it
+        values = bytes(buffer[42 : 6 + msg_len])
 
         return GrowattModbusFunctionMultiple(
             device_id=device_id,
             function=function,
             start=start,
             end=end,
-            value=value,
+            values=values,
         )
 
     def build_grobro(self) -> bytes:
-        header = struct.pack(
-            MODBUS_COMMAND_STRUCT,
+        header = MODBUS_COMMAND.pack(
             1,
             7,
             36 + len(self.values),
             1,
             self.function,
-            self.device_id.encode("ascii").ljust(30, b"\x00"),  # device_id
+            encode_device_id(self.device_id),
             self.start,
             self.end,
         )
@@ -102,7 +104,7 @@ class GrowattModbusFunctionSingle(BaseModel):
             device_id_raw,
             register,
             value,
-        ) = struct.unpack(MODBUS_COMMAND_STRUCT, buffer[0:42])
+        ) = MODBUS_COMMAND.unpack_from(buffer)
 
         device_id = device_id_raw.decode("ascii", errors="ignore").strip("\x00")
 
@@ -114,14 +116,13 @@ class GrowattModbusFunctionSingle(BaseModel):
         )
 
     def build_grobro(self) -> bytes:
-        return struct.pack(
-            MODBUS_COMMAND_STRUCT,
+        return MODBUS_COMMAND.pack(
             1,
             7,
             36,
             1,
             self.function,
-            self.device_id.encode("ascii").ljust(30, b"\x00"),  # device_id
+            encode_device_id(self.device_id),
             self.register,
             self.value,
         )
@@ -2,6 +2,8 @@ from rope.base import serializer
 from typing import Optional
 from datetime import datetime
 import struct
+import bisect
+import functools
 import logging
 from pydantic.main import BaseModel
 from enum import Enum
@@ -11,6 +13,17 @@ from grobro.model.growatt_registers import GrowattRegisterPosition
 LOG = logging.getLogger(__name__)
 
 HEADER_STRUCT = ">HHHBB30s"
+HEADER = struct.Struct(HEADER_STRUCT)
+BLOCK_HEADER = struct.Struct(">HH")
+METADATA = struct.Struct(">30s7B")
+
+
+@functools.lru_cache(maxsize=256)
+def encode_device_id(device_id: str) -> bytes:
+    """
+    Zero-padded 30 byte device id as used in message headers.
+    """
+    return device_id.encode("ascii").ljust(30, b"\x00")
 
 
 class GrowattModbusBlock(BaseModel):
@@ -30,12 +43,13 @@ class GrowattModbusBlock(BaseModel):
     values: bytes
 
     @staticmethod
-    def parse_grobro(buffer) -> Optional["GrowattModbusBlock"]:
+    def parse_grobro(buffer: bytes, offset: int = 0) -> Optional["GrowattModbusBlock"]:
         try:
-            (start, end) = struct.unpack(">HH", buffer[0:4])
+            (start, end) = BLOCK_HEADER.unpack_from(buffer, offset)
             num_blocks = end - start + 1
-            result = GrowattModbusBlock(
-                start=start, end=end, values=buffer[4 : 4 + num_blocks * 2]
+            offset += BLOCK_HEADER.size
+            result = GrowattModbusBlock.model_construct(
+                start=start, end=end, values=buffer[offset : offset + num_blocks * 2]
             )
             assert len(result.values) == num_blocks * 2
             return result
@@ -43,10 +57,10 @@ class GrowattModbusBlock(BaseModel):
             LOG.warn("Parsing GrowattModbusBlock: %s", e)
 
     def build_grobro(self) -> bytes:
-        result = struct.pack(">HH", self.start, self.end) + self.values
+        result = BLOCK_HEADER.pack(self.start, self.end) + self.values
         return result
 
-    def size(self):
+    def size(self) -> int:
         return 4 + len(self.values)
 
 
@@ -58,6 +72,10 @@ class GrowattModbusFunction(int, Enum):
     PRESET_MULTIPLE_REGISTER = 16
 
 
+MODBUS_FUNCTIONS = frozenset(GrowattModbusFunction)
+READ_INPUT_REGISTER = GrowattModbusFunction.READ_INPUT_REGISTER
+
+
 class GrowattMetadata(BaseModel):
     """
     Represents metadata within a READ_INPUT_REGISTER message.
@@ -70,38 +88,42 @@ class GrowattMetadata(BaseModel):
     device_sn: str
     timestamp: Optional[datetime]
 
-    def size(self):
+    def size(self) -> int:
         return 37
 
     @staticmethod
-    def parse_grobro(buffer) -> Optional["GrowattMetadata"]:
-        offset = 0
-        device_serial_raw = struct.unpack(">30s", buffer[offset : offset + 30])[0]
+    def parse_grobro(buffer: bytes, offset: int = 0) -> Optional["GrowattMetadata"]:
+        (
+            device_serial_raw,
+            year,
+            month,
+            day,
+            hour,
+            minute,
+            second,
+            millis,
+        ) = METADATA.unpack_from(buffer, offset)
         device_serial = device_serial_raw.decode("ascii", errors="ignore").strip("\x00")
-        offset += 30
-        year, month, day, hour, minute, second, millis = struct.unpack(
-            ">7B", buffer[offset : offset + 7]
-        )
-        timestamp = None
         try:
             timestamp = datetime(
-                year + 2000, month, day, hour, minute, second, microsecond=millis * 1000
+                year + 2000, month, day, hour, minute, second, millis * 1000
             )
-        except Exception:
-            pass
-        return GrowattMetadata(device_sn=device_serial, timestamp=timestamp)
+        except ValueError:
+            # e.g. all zero when the device has no valid date
+            timestamp = None
+        return GrowattMetadata.model_construct(device_sn=device_serial, timestamp=timestamp)
 
     def build_grobro(self) -> bytes:
-        result = struct.pack(
-            ">30s7B",
-            self.device_sn.encode("ascii").ljust(30, b"\x00"),  # device_id
-            self.timestamp.year - 2000,
-            self.timestamp.month,
-            self.timestamp.day,
-            self.timestamp.hour,
-            self.timestamp.minute,
-            self.timestamp.second,
-            int(self.timestamp.microsecond / 1000),
+        ts = self.timestamp
+        result = METADATA.pack(
+            encode_device_id(self.device_sn),
+            ts.year - 2000,
+            ts.month,
+            ts.day,
+            ts.hour,
+            ts.minute,
+            ts.second,
+            ts.microsecond // 1000,
         )
         return result
 
@@ -128,7 +150,7 @@ class GrowattModbusMessage(BaseModel):
     register_blocks: list[GrowattModbusBlock]
 
     @property
-    def msg_len(self):
+    def msg_len(self) -> int:
         result = 32  # 2 byte msg_type + 30 byte device id
         if self.metadata:
             result += self.metadata.size()
@@ -136,65 +158,81 @@ class GrowattModbusMessage(BaseModel):
             result += block.size()
         return result
 
-    def get_data(self, pos: GrowattRegisterPosition):
-        for block in self.register_blocks:
-            if block.start > pos.register_no or block.end < pos.register_no:
-                continue
-            block_pos = (pos.register_no - block.start) * 2 + pos.offset
-            return block.values[block_pos : block_pos + pos.size]
-        return None
+    @functools.cached_property
+    def _blocks_by_start(self) -> tuple[list[int], list[GrowattModbusBlock]]:
+        blocks = sorted(self.register_blocks, key=lambda block: block.start)
+        return [block.start for block in blocks], blocks
+
+    def get_data(self, pos: GrowattRegisterPosition) -> Optional[bytes]:
+        starts, blocks = self._blocks_by_start
+        i = bisect.bisect_right(starts, pos.register_no) - 1
+        if i < 0:
+            return None
+        block = blocks[i]
+        if block.end < pos.register_no:
+            return None
+        block_pos = (pos.register_no - block.start) * 2 + pos.offset
+        return block.values[block_pos : block_pos + pos.size]
 
     @staticmethod
-    def parse_grobro(buffer) -> Optional["GrowattModbusMessage"]:
+    def parse_grobro(buffer: bytes) -> Optional["GrowattModbusMessage"]:
+        if len(buffer) < HEADER.size:
+            LOG.warning("parsing GrowattModbusMessage: message too short (%s bytes)", len(buffer))
+            return None
         try:
             (unknown, constant_7, msg_len, constant_1, function, device_id_raw) = (
-                struct.unpack(
-                    HEADER_STRUCT,
-                    buffer[0:38],
-                )
+                HEADER.unpack_from(buffer)
             )
-            if msg_len != len(buffer[8:]):
+            if msg_len != len(buffer) - 8:
                 return None
             device_id = device_id_raw.decode("ascii", errors="ignore").strip("\x00")
-            if function not in [e.value for e in GrowattModbusFunction]:
+            if function not in MODBUS_FUNCTIONS:
                 LOG.info("Unknown modbus function for %s: %s", device_id, function)
                 return None
 
             register_blocks = []
-            offset = 38
+            offset = HEADER.size
 
             metadata = None
-            if function == GrowattModbusFunction.READ_INPUT_REGISTER:
-                metadata = GrowattMetadata.parse_grobro(buffer[offset:])
+            if function == READ_INPUT_REGISTER:
+                metadata = GrowattMetadata.parse_grobro(buffer, offset)
                 offset += metadata.size()
 
+            unpack_block_header = BLOCK_HEADER.unpack_from
             while len(buffer) > offset + 6:
-                block = GrowattModbusBlock.parse_grobro(buffer[offset:])
-                register_blocks.append(block)
-                offset += block.size()
+                start, end = unpack_block_header(buffer, offset)
+                values_start = offset + BLOCK_HEADER.size
+                offset = values_start + (end - start + 1) * 2
+                values = buffer[values_start:offset]
+                if len(values) != offset - values_start:
+                    LOG.warning("Truncated register block %s-%s for %s", start, end, device_id)
+                    return None
+                register_blocks.append(
+                    GrowattModbusBlock.model_construct(start=start, end=end, values=values)
+                )
 
-            return GrowattModbusMessage(
+            # values are already typed by the unpacking, so skip validation
+            return GrowattModbusMessage.model_construct(
                 unknown=unknown,
                 metadata=metadata,
                 device_id=device_id,
-                function=function,
+                function=GrowattModbusFunction(function),
                 register_blocks=register_blocks,
             )
-        except Exception as e:
-            LOG.warn("parsing GrowattModbusMessage: %s", e)
+        except (struct.error, ValueError) as e:
+            LOG.warning("parsing GrowattModbusMessage: %s", e)
 
     def build_grobro(self) -> bytes:
-        result = struct.pack(
-            HEADER_STRUCT,
+        result = HEADER.pack(
             self.unknown,
             7,
             self.msg_len,
             1,
             self.function,
-            self.device_id.encode("ascii").ljust(30, b"\x00"),  # device_id
+            encode_device_id(self.device_id),
         )
+        parts = [result]
         if self.metadata:
-            result += self.metadata.build_grobro()
-        for block in self.register_blocks:
-            result += block.build_grobro()
-        return result
+            parts.append(self.metadata.build_grobro())
+        parts.extend(block.build_grobro() for block in self.register_blocks)
+        return b"".join(parts)
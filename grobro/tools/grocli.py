@@ -4,64 +4,71 @@ import argparse
 import struct
 import sys
 import random
-import time
+import threading
 import paho.mqtt.client as mqtt
 import crc
 import ssl
 
-crc16 = crc.Calculator(crc.Crc16.MODBUS)
+crc16 = crc.Calculator(crc.Crc16.MODBUS, optimized=True)
+CRC = struct.Struct("!H")
 
 def scramble(pkt: bytes) -> bytes:
     mask = b"Growatt"
-    out = bytearray(pkt[:8])
-    out += bytes(b ^ mask[i % len(mask)] for i, b in enumerate(pkt[8:]))
-    return bytes(out)
+    n = len(pkt) - 8
+    if n <= 0:
+        return bytes(pkt)
+    # XOR the body with the repeated mask as one big integer
+    tile = (mask * (n // len(mask) + 1))[:n]
+    body = int.from_bytes(pkt[8:], "big") ^ int.from_bytes(tile, "big")
+    return bytes(pkt[:8]) + body.to_bytes(n, "big")
 
 def append_crc(pkt: bytes) -> bytes:
     csum = crc16.checksum(pkt)
-    return pkt + struct.pack("!H", csum)
+    return pkt + CRC.pack(csum)
+
+# printable ascii stays, everything else is shown as "."
+HEXDUMP_ASCII = bytes(b if 32 <= b <= 126 else 0x2E for b in range(256))
 
 def hexdump(data: bytes, width: int = 16) -> None:
     for i in range(0, len(data), width):
         chunk = data[i: i + width]
-        hex_part = " ".join(f"{b:02X}" for b in chunk)
-        asc_part = "".join(chr(b) if 32 <= b <= 126 else "." for b in chunk)
+        hex_part = chunk.hex(" ").upper()
+        asc_part = chunk.translate(HEXDUMP_ASCII).decode("ascii")
         print(f"{i:08X}  {hex_part:<{width * 3}} |{asc_part}|")
 
 # --- Message Builders ---
 
+# Each message is packed in one go: constant 1, constant 7, message length,
+# message type, zero-padded device id, reserved zeros, message body.
+CHARGE_LIMIT = struct.Struct(">HHHH16s15x3sHH")
+OUTPUT_LIMIT = struct.Struct(">HHHH16s15xBH")
+INVERTER_CONFIG = struct.Struct(">HHHH16s14xH")
+SLOT_CREATE = struct.Struct(">HHHH16s14xIBBBB2xHH")
+SLOT_DELETE = struct.Struct(">HHHH16s14xI10x")
+SMART_POWERSET = struct.Struct(">HHHH16s14xHHHHH")
+DEVICE_ID_LENGTH = 16
+
+def encode_device_id(device_id: str) -> bytes:
+    # the 16s fields would silently cut longer ids
+    dev_bytes = device_id.encode("ascii")
+    if len(dev_bytes) > DEVICE_ID_LENGTH:
+        raise ValueError(f"Device id {device_id} is longer than {DEVICE_ID_LENGTH} characters")
+    return dev_bytes
+
 def build_charge_limit(device_id: str, upper: int, lower: int) -> bytes:
-    header = struct.pack(">HHH", 1, 7, 40)
-    mtype = 0x0110
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 15) + b"\xFA\x00\xFB" + struct.pack(">HH", upper, lower)
-    return header + struct.pack(">H", mtype) + payload
+    return CHARGE_LIMIT.pack(1, 7, 40, 0x0110, encode_device_id(device_id), b"\xFA\x00\xFB", upper, lower)
 
 def build_output_limit(device_id: str, power: int) -> bytes:
-    header = struct.pack(">HHH", 1, 7, 36)
-    mtype = 0x0106
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 15) + b"\xFC" + struct.pack(">H", power)
-    return header + struct.pack(">H", mtype) + payload
+    return OUTPUT_LIMIT.pack(1, 7, 36, 0x0106, encode_device_id(device_id), 0xFC, power)
 
 def build_inverter_config(device_id: str, model_hex: str) -> bytes:
     # Hoymiles HMS-1600-4T = 0204
     # APsystems EZ1-M = 0401
-    header = struct.pack(">HHH", 1, 7, 36)
-    mtype = 0x0106
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 14) + b"\x01\x2C" + bytes.fromhex(model_hex)
-    return header + struct.pack(">H", mtype) + payload
+    header = INVERTER_CONFIG.pack(1, 7, 36, 0x0106, encode_device_id(device_id), 0x012C)
+    return header + bytes.fromhex(model_hex)
 
 def build_slot(device_id: str, action: str, slot: int, start: str = None, end: str = None, power: int = 0) -> bytes:
-    import struct
-
-    header = struct.pack(">HHH", 1, 7, 46)  # Fixed header fields
-    mtype = 0x0110  # Message type
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-
-    payload = dev_bytes
-    payload += b"\x00" * 14  # Reserved padding
+    dev_bytes = encode_device_id(device_id)
 
     """
     depending on the slot, we set the start and end register
@@ -73,32 +80,21 @@ def build_slot(device_id: str, action: str, slot: int, start: str = None, end: s
             4: 0x010D0111, # 269 - 273
             5: 0x01120116, # 274 - 278
     }.get(slot, 0x01010100)
-    payload += control_bytes.to_bytes(4, byteorder='big')
 
     if action == "slot_create":
         sh, sm = map(int, start.split(":"))
         eh, em = map(int, end.split(":"))
-        payload += struct.pack(">BBBB", sh, sm, eh, em)
-
-        payload += b"\x00\x00"  # Reserved
-        payload += struct.pack(">H", power)
-        payload += b"\x00\x01"  # Fixed ending
+        # start and end time, reserved, power, fixed ending
+        return SLOT_CREATE.pack(1, 7, 46, 0x0110, dev_bytes, control_bytes, sh, sm, eh, em, power, 1)
 
     elif action == "slot_delete":
-        payload += b"\x00" * 4  # Clear times
-        payload += b"\x00\x00"  # Reserved
-        payload += b"\x00" * 4  # Clear power/flag
+        # times, reserved and power/flag are all cleared
+        return SLOT_DELETE.pack(1, 7, 46, 0x0110, dev_bytes, control_bytes)
 
     else:
         raise ValueError(f"Unknown slot action {action}")
 
-    return header + struct.pack(">H", mtype) + payload
-
 def build_smart_powerset(device_id: str, action: str, powerdiff: int) -> bytes:
-    header = struct.pack(">HHH", 1, 7, 42)
-    mtype = 0x0110
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    
     setup = 0
     setdown = 0
     if action == "power_set_up":
@@ -108,40 +104,82 @@ def build_smart_powerset(device_id: str, action: str, powerdiff: int) -> bytes:
     else:
         raise ValueError(f"Unknown smart powerset action {action}")
 
-    payload = dev_bytes + (b"\x00" * 14) + b"\x01\x36\x01\x38" + struct.pack(">HHH", setdown, setup, 1)
-
-    return header + struct.pack(">H", mtype) + payload
+    return SMART_POWERSET.pack(
+        1, 7, 42, 0x0110, encode_device_id(device_id), 0x0136, 0x0138, setdown, setup, 1
+    )
 
 # --- MQTT ---
 
-def on_connect(client, userdata, flags, rc):
-    if rc != 0:
-        print(f"Failed to connect, return code {rc}")
+CONNECT_TIMEOUT = 5
+PUBLISH_TIMEOUT = 2
+
+class MqttSession:
+    """
+    Broker connection which stays open for all publishes within the with block.
+    """
+
+    def __init__(self, broker, port, username, password, tls):
+        self.broker = broker
+        self.port = port
+        self.connected = threading.Event()
+        # set once the first connection attempt succeeded or failed
+        self.attempted = threading.Event()
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"grobro-{random.randint(0,9999)}",
+        )
+        if username:
+            self.client.username_pw_set(username, password)
+        if tls:
+            self.client.tls_set(cert_reqs=ssl.CERT_NONE)
+            self.client.tls_insecure_set(True)
+        self.client.on_connect = self.on_connect
+        self.client.on_connect_fail = self.on_connect_fail
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print(f"Failed to connect, return code {reason_code}")
+        else:
+            self.connected.set()
+        self.attempted.set()
+
+    def on_connect_fail(self, client, userdata):
+        self.attempted.set()
+
+    def __enter__(self):
+        try:
+            self.client.connect(self.broker, self.port)
+        except OSError as e:
+            # DNS failures, unreachable hosts, timeouts and refused connections
+            raise ConnectionError(f"Could not connect to {self.broker}:{self.port}: {e}") from e
+        self.client.loop_start()
+        # fail right away on a refused connection instead of waiting for paho's retries
+        if not self.attempted.wait(CONNECT_TIMEOUT) or not self.connected.is_set():
+            self.client.loop_stop()
+            raise ConnectionError(f"Could not connect to {self.broker}:{self.port}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, device_id, payload):
+        topic = f"s/33/{device_id}"
+        result = self.client.publish(topic, payload)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            result.wait_for_publish(PUBLISH_TIMEOUT)
+        if result.is_published():
+            print(f"Sent message to topic {topic}")
+        else:
+            print(f"Failed to send message")
 
 def publish_message(broker, port, username, password, tls, device_id, payload):
-    topic = f"s/33/{device_id}"
-    client_id = f"grobro-{random.randint(0,9999)}"
-
-    client = mqtt.Client(client_id=client_id)
-    if username:
-        client.username_pw_set(username, password)
-    if tls:
-        client.tls_set(cert_reqs=ssl.CERT_NONE)
-        client.tls_insecure_set(True)
-
-    client.on_connect = on_connect
-    client.connect(broker, port)
-    client.loop_start()
-
-    time.sleep(1)  # wait for connection
-    result = client.publish(topic, payload)
-    status = result[0]
-    if status == 0:
-        print(f"Sent message to topic {topic}")
-    else:
-        print(f"Failed to send message")
-    time.sleep(1)
-    client.loop_stop()
+    try:
+        with MqttSession(broker, port, username, password, tls) as session:
+            session.publish(device_id, payload)
+    except ConnectionError as e:
+        print(e)
+        sys.exit(1)
 
 # --- Main ---
 
@@ -171,6 +209,10 @@ def main():
 
     args = parser.parse_args()
 
+    if len(args.device_id) > DEVICE_ID_LENGTH:
+        print(f"Error: --device-id must be at most {DEVICE_ID_LENGTH} characters")
+        sys.exit(1)
+
     if args.action == "charge_limit":
         if args.upper is None or args.lower is None:
             print("Error: --upper and --lower are required for charge_limit")
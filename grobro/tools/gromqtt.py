@@ -36,6 +36,10 @@ Example of JSON command messages:
 5. Deleting a time slot:
    {"device_id": "0PVP50xxxxxxxxxx", "action": "slot_delete", "slot": 1}
 
+Several commands can be sent at once as a JSON list, they are forwarded in order:
+   [{"device_id": "0PVP50xxxxxxxxxx", "action": "slot_delete", "slot": 1},
+    {"device_id": "0PVP50xxxxxxxxxx", "action": "slot_create", "slot": 1, "start": "06:00", "end": "12:00", "power": 500}]
+
 usage: gromqtt.py [-h] --source-mqtt-broker SOURCE_MQTT_BROKER [--source-mqtt-port SOURCE_MQTT_PORT]
                   [--source-mqtt-username SOURCE_MQTT_USERNAME] [--source-mqtt-password SOURCE_MQTT_PASSWORD] [--source-mqtt-tls]
                   --target-mqtt-broker TARGET_MQTT_BROKER [--target-mqtt-port TARGET_MQTT_PORT] [--target-mqtt-username TARGET_MQTT_USERNAME]
@@ -43,131 +47,163 @@ usage: gromqtt.py [-h] --source-mqtt-broker SOURCE_MQTT_BROKER [--source-mqtt-po
 """
 
 import argparse
+import functools
 import struct
 import sys
-import random
-import time
+import secrets
+import threading
 import json
 import paho.mqtt.client as mqtt
 import crc
 import ssl
 
-crc16 = crc.Calculator(crc.Crc16.MODBUS)
+crc16 = crc.Calculator(crc.Crc16.MODBUS, optimized=True)
+CRC = struct.Struct("!H")
 
-def scramble(pkt: bytes) -> bytes:
+@functools.lru_cache(maxsize=64)
+def scramble_mask(length: int) -> int:
+    # "Growatt" repeated to length bytes, as integer
     mask = b"Growatt"
-    out = bytearray(pkt[:8])
-    out += bytes(b ^ mask[i % len(mask)] for i, b in enumerate(pkt[8:]))
-    return bytes(out)
+    return int.from_bytes((mask * (length // len(mask) + 1))[:length], "big")
+
+def scramble(pkt: bytes) -> bytes:
+    n = len(pkt) - 8
+    if n <= 0:
+        return bytes(pkt)
+    # XOR the body with the repeated mask as one big integer
+    body = int.from_bytes(pkt[8:], "big") ^ scramble_mask(n)
+    return bytes(pkt[:8]) + body.to_bytes(n, "big")
 
 def append_crc(pkt: bytes) -> bytes:
     csum = crc16.checksum(pkt)
-    return pkt + struct.pack("!H", csum)
+    return pkt + CRC.pack(csum)
+
+# printable ascii stays, everything else is shown as "."
+HEXDUMP_ASCII = bytes(b if 32 <= b <= 126 else 0x2E for b in range(256))
 
 def hexdump(data: bytes, width: int = 16) -> None:
     for i in range(0, len(data), width):
         chunk = data[i: i + width]
-        hex_part = " ".join(f"{b:02X}" for b in chunk)
-        asc_part = "".join(chr(b) if 32 <= b <= 126 else "." for b in chunk)
+        hex_part = chunk.hex(" ").upper()
+        asc_part = chunk.translate(HEXDUMP_ASCII).decode("ascii")
         print(f"{i:08X}  {hex_part:<{width * 3}} |{asc_part}|")
 
 # --- Message Builders ---
 
+# Fixed header (constant 1, constant 7, message length) followed by the message type
+CHARGE_LIMIT_HEADER = struct.pack(">HHHH", 1, 7, 40, 0x0110)
+OUTPUT_LIMIT_HEADER = struct.pack(">HHHH", 1, 7, 36, 0x0106)
+INVERTER_CONFIG_HEADER = struct.pack(">HHHH", 1, 7, 36, 0x0106)
+SLOT_HEADER = struct.pack(">HHHH", 1, 7, 46, 0x0110)
+
+# Reserved zeros between device id and the command, followed by the command's marker
+RESERVED_PADDING = b"\x00" * 14
+CHARGE_LIMIT_MARKER = RESERVED_PADDING + b"\x00\xFA\x00\xFB"
+OUTPUT_LIMIT_MARKER = RESERVED_PADDING + b"\x00\xFC"
+INVERTER_CONFIG_MARKER = RESERVED_PADDING + b"\x01\x2C"
+SLOT_CLEARED = b"\x00" * 10  # cleared times, reserved, cleared power/flag
+
+CHARGE_LIMIT_VALUES = struct.Struct(">HH")  # upper, lower
+OUTPUT_LIMIT_VALUE = struct.Struct(">H")  # power
+SLOT_CONTROL = struct.Struct(">BBBB")  # marker, control bytes
+SLOT_VALUES = struct.Struct(">BBBB2xHH")  # times, reserved, power, fixed ending
+
+SLOT_CONTROL_BYTES = {
+    1: (0x01, 0x02, 0x00),  # (Unknown 1, Unknown 2, Unknown 3)
+    2: (0x03, 0x01, 0x07),
+    3: (0x08, 0x01, 0x0C),
+    4: (0x0D, 0x01, 0x11),
+    5: (0x12, 0x01, 0x16),
+}
+SLOT_CONTROL_DEFAULT = (0x01, 0x01, 0x00)
+
+@functools.lru_cache(maxsize=32)
+def encode_device_id(device_id: str) -> bytes:
+    return device_id.encode("ascii").ljust(16, b"\x00")
+
 def build_charge_limit(device_id: str, upper: int, lower: int) -> bytes:
-    header = struct.pack(">HHH", 1, 7, 40)
-    mtype = 0x0110
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 15) + b"\xFA\x00\xFB" + struct.pack(">HH", upper, lower)
-    return header + struct.pack(">H", mtype) + payload
+    return b"".join((
+        CHARGE_LIMIT_HEADER,
+        encode_device_id(device_id),
+        CHARGE_LIMIT_MARKER,
+        CHARGE_LIMIT_VALUES.pack(upper, lower),
+    ))
 
 def build_output_limit(device_id: str, power: int) -> bytes:
     # Ensure power is within valid range (0-800)
     power = max(0, min(power, 800))
     
-    header = struct.pack(">HHH", 1, 7, 36)
-    mtype = 0x0106
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 15) + b"\xFC" + struct.pack(">H", power)
-    return header + struct.pack(">H", mtype) + payload
+    return b"".join((
+        OUTPUT_LIMIT_HEADER,
+        encode_device_id(device_id),
+        OUTPUT_LIMIT_MARKER,
+        OUTPUT_LIMIT_VALUE.pack(power),
+    ))
 
 def build_inverter_config(device_id: str, model_hex: str) -> bytes:
     # Hoymiles HMS-1600-4T = 0204
     # APsystems EZ1-M = 0401
-    header = struct.pack(">HHH", 1, 7, 36)
-    mtype = 0x0106
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
-    payload = dev_bytes + (b"\x00" * 14) + b"\x01\x2C" + bytes.fromhex(model_hex)
-    return header + struct.pack(">H", mtype) + payload
+    return b"".join((
+        INVERTER_CONFIG_HEADER,
+        encode_device_id(device_id),
+        INVERTER_CONFIG_MARKER,
+        bytes.fromhex(model_hex),
+    ))
 
 def build_slot(device_id: str, action: str, slot: int, start: str = None, end: str = None, power: int = 0) -> bytes:
-    import struct
-
     # Ensure power is within valid range (0-800)
     power = max(0, min(power, 800))
 
-    header = struct.pack(">HHH", 1, 7, 46)  # Fixed header fields
-    mtype = 0x0110  # Message type
-    dev_bytes = device_id.encode("ascii").ljust(16, b"\x00")
+    # Header, device id and reserved padding
+    parts = [SLOT_HEADER, encode_device_id(device_id), RESERVED_PADDING]
 
-    payload = dev_bytes
-    payload += b"\x00" * 14  # Reserved padding
+    control1, control2, extra = SLOT_CONTROL_BYTES.get(slot, SLOT_CONTROL_DEFAULT)
 
-    control_bytes = {
-        1: (0x01, 0x02, 0x00),  # (Unknown 1, Unknown 2, Unknown 3)
-        2: (0x03, 0x01, 0x07),
-        3: (0x08, 0x01, 0x0C),
-        4: (0x0D, 0x01, 0x11),
-        5: (0x12, 0x01, 0x16),
-    }
+    if action not in ("slot_create", "slot_delete"):
+        raise ValueError(f"Unknown slot action {action}")
 
-    control1, control2, extra = control_bytes.get(slot, (0x01, 0x01, 0x00))
+    if slot == 1:
+        parts.append(SLOT_CONTROL.pack(0x00, 0xFE, control1, control2))
+    else:
+        parts.append(SLOT_CONTROL.pack(0x01, control1, control2, extra))
 
     if action == "slot_create":
-        if slot == 1:
-            payload += b"\x00\xFE"
-            payload += struct.pack(">BB", control1, control2)
-        else:
-            payload += b"\x01"
-            payload += struct.pack(">BBB", control1, control2, extra)
-
         sh, sm = map(int, start.split(":"))
         eh, em = map(int, end.split(":"))
-        payload += struct.pack(">BBBB", sh, sm, eh, em)
-
-        payload += b"\x00\x00"  # Reserved
-        payload += struct.pack(">H", power)
-        payload += b"\x00\x01"  # Fixed ending
-
-    elif action == "slot_delete":
-        if slot == 1:
-            payload += b"\x00\xFE"
-            payload += struct.pack(">BB", control1, control2)
-        else:
-            payload += b"\x01"
-            payload += struct.pack(">BBB", control1, control2, extra)
-
-        payload += b"\x00" * 4  # Clear times
-        payload += b"\x00\x00"  # Reserved
-        payload += b"\x00" * 4  # Clear power/flag
-
+        # Times, reserved, power, fixed ending
+        parts.append(SLOT_VALUES.pack(sh, sm, eh, em, power, 0x0001))
     else:
-        raise ValueError(f"Unknown slot action {action}")
+        parts.append(SLOT_CLEARED)
 
-    return header + struct.pack(">H", mtype) + payload
+    return b"".join(parts)
 
 # --- MQTT ---
 
+CONNECT_TIMEOUT = 5  # seconds to wait for the source broker before giving up
+
 def on_source_connect(client, userdata, flags, rc):
     if rc != 0:
         print(f"Failed to connect to source broker, return code {rc}")
     else:
         print("Connected to source MQTT broker")
+        userdata["connected"].set()
+    userdata["attempted"].set()
 
-def publish_message(broker, port, username, password, tls, device_id, payload):
-    topic = f"s/33/{device_id}"
-    client_id = f"grobro-{random.randint(0,9999)}"
+def on_source_connect_fail(client, userdata):
+    print("Failed to connect to source broker")
+    userdata["attempted"].set()
+
+def on_source_disconnect(client, userdata, rc):
+    userdata["connected"].clear()
 
-    client = mqtt.Client(client_id=client_id)
+def connect_source(broker, port, username, password, tls) -> mqtt.Client:
+    """
+    Open the source broker connection once; it is reused for every command.
+    """
+    client_id = f"grobro-{secrets.token_hex(2)}"
+
+    state = {"connected": threading.Event(), "attempted": threading.Event()}
+    client = mqtt.Client(client_id=client_id, userdata=state)
     if username:
         client.username_pw_set(username, password)
     if tls:
@@ -175,18 +211,28 @@ def publish_message(broker, port, username, password, tls, device_id, payload):
         client.tls_insecure_set(True)
 
     client.on_connect = on_source_connect
-    client.connect(broker, port)
+    client.on_connect_fail = on_source_connect_fail
+    client.on_disconnect = on_source_disconnect
+    client.connect_async(broker, port)
     client.loop_start()
+    return client
+
+def publish_message(client, device_id, payload):
+    topic = f"s/33/{device_id}"
+
+    # Only the first connection attempt is waited for, once that has failed
+    # or the connection is lost, commands fail right away while paho reconnects
+    state = client.user_data_get()
+    if not state["attempted"].wait(CONNECT_TIMEOUT) or not state["connected"].is_set():
+        print("Failed to send message: not connected to source broker")
+        return
 
-    time.sleep(1)  # wait for connection
+    # QoS 0, so there is no acknowledgement to wait for
     result = client.publish(topic, payload)
-    status = result[0]
-    if status == 0:
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
         print(f"Sent message to topic {topic}")
     else:
         print(f"Failed to send message")
-    time.sleep(1)
-    client.loop_stop()
 
 # --- Target MQTT Functions ---
 
@@ -198,101 +244,103 @@ def on_target_connect(client, userdata, flags, rc):
         client.subscribe(userdata.get("topic", "grobro/cmd"))
         print(f"Subscribed to {userdata.get('topic', 'grobro/cmd')}")
 
-def on_target_message(client, userdata, msg):
-    print(f"Received message on {msg.topic}")
-    try:
-        # Parse the incoming JSON message
-        data = json.loads(msg.payload.decode())
-        print(f"Received command: {data}")
+def handle_command(data, userdata):
+    print(f"Received command: {data}")
+    
+    # Extract required parameters
+    device_id = data.get("device_id")
+    action = data.get("action")
+    
+    if not device_id or not action:
+        print("Error: Missing required parameters (device_id or action)")
+        return
         
-        # Extract required parameters
-        device_id = data.get("device_id")
-        action = data.get("action")
+    # Process based on action type
+    if action == "charge_limit":
+        upper = data.get("upper")
+        lower = data.get("lower")
+        if upper is None or lower is None:
+            print("Error: Missing parameters for charge_limit (upper or lower)")
+            return
+        pkt = build_charge_limit(device_id, upper, lower)
         
-        if not device_id or not action:
-            print("Error: Missing required parameters (device_id or action)")
+    elif action == "output_limit":
+        power = data.get("power")
+        if power is None:
+            print("Error: Missing power parameter for output_limit")
             return
             
-        # Process based on action type
-        if action == "charge_limit":
-            upper = data.get("upper")
-            lower = data.get("lower")
-            if upper is None or lower is None:
-                print("Error: Missing parameters for charge_limit (upper or lower)")
-                return
-            pkt = build_charge_limit(device_id, upper, lower)
+        # Validate power range
+        if power < 0 or power > 800:
+            print(f"Warning: Power value {power} outside valid range (0-800). Will be clamped.")
+            
+        pkt = build_output_limit(device_id, power)
+        
+    elif action == "inverter_config":
+        model_id = data.get("model_id")
+        if not model_id:
+            print("Error: Missing model_id parameter for inverter_config")
+            return
+        pkt = build_inverter_config(device_id, model_id)
+        
+    elif action in ("slot_create", "slot_delete"):
+        slot = data.get("slot")
+        if slot is None:
+            print("Error: Missing slot parameter for slot operation")
+            return
             
-        elif action == "output_limit":
+        if action == "slot_create":
+            start = data.get("start")
+            end = data.get("end")
             power = data.get("power")
-            if power is None:
-                print("Error: Missing power parameter for output_limit")
+            if not start or not end or power is None:
+                print("Error: Missing parameters for slot_create")
                 return
                 
             # Validate power range
             if power < 0 or power > 800:
                 print(f"Warning: Power value {power} outside valid range (0-800). Will be clamped.")
                 
-            pkt = build_output_limit(device_id, power)
-            
-        elif action == "inverter_config":
-            model_id = data.get("model_id")
-            if not model_id:
-                print("Error: Missing model_id parameter for inverter_config")
-                return
-            pkt = build_inverter_config(device_id, model_id)
-            
-        elif action in ("slot_create", "slot_delete"):
-            slot = data.get("slot")
-            if slot is None:
-                print("Error: Missing slot parameter for slot operation")
-                return
-                
-            if action == "slot_create":
-                start = data.get("start")
-                end = data.get("end")
-                power = data.get("power")
-                if not start or not end or power is None:
-                    print("Error: Missing parameters for slot_create")
-                    return
-                    
-                # Validate power range
-                if power < 0 or power > 800:
-                    print(f"Warning: Power value {power} outside valid range (0-800). Will be clamped.")
-                    
-                pkt = build_slot(device_id, action, slot, start, end, power)
-            else:
-                pkt = build_slot(device_id, action, slot)
-                
+            pkt = build_slot(device_id, action, slot, start, end, power)
         else:
-            print(f"Error: Unknown action '{action}'")
-            return
+            pkt = build_slot(device_id, action, slot)
             
-        # Process and send the message
-        scrambled = scramble(pkt)
-        final_payload = append_crc(scrambled)
+    else:
+        print(f"Error: Unknown action '{action}'")
+        return
         
-        if userdata.get("hexdump", False):
-            print("\n--- Message ---")
-            hexdump(pkt)
-            print("\n--- Final Message ---")
-            hexdump(final_payload)
-            
-        # Send via source MQTT broker
-        source_config = userdata.get("source_mqtt", {})
-        publish_message(
-            broker=source_config.get("broker"),
-            port=source_config.get("port", 1883),
-            username=source_config.get("username"),
-            password=source_config.get("password"),
-            tls=source_config.get("tls", False),
-            device_id=device_id,
-            payload=final_payload
-        )
+    # Process and send the message
+    scrambled = scramble(pkt)
+    final_payload = append_crc(scrambled)
+    
+    if userdata.get("hexdump", False):
+        print("\n--- Message ---")
+        hexdump(pkt)
+        print("\n--- Final Message ---")
+        hexdump(final_payload)
         
+    # Send via source MQTT broker
+    publish_message(userdata["source_client"], device_id, final_payload)
+
+def on_target_message(client, userdata, msg):
+    print(f"Received message on {msg.topic}")
+    try:
+        # Parse the incoming JSON message
+        data = json.loads(msg.payload)
     except json.JSONDecodeError:
         print("Error: Invalid JSON format in message")
+        return
     except Exception as e:
         print(f"Error processing message: {e}")
+        return
+
+    # A list of commands is sent in order over the same source connection
+    commands = data if isinstance(data, list) else [data]
+    for command in commands:
+        try:
+            handle_command(command, userdata)
+        except Exception as e:
+            print(f"Error processing message: {e}")
 
 # --- Main ---
 
@@ -318,19 +366,23 @@ def main():
 
     args = parser.parse_args()
     
+    # Connect to the source broker once, commands are published over this client
+    print(f"Connecting to source MQTT broker at {args.source_mqtt_broker}:{args.source_mqtt_port}")
+    source_client = connect_source(
+        broker=args.source_mqtt_broker,
+        port=args.source_mqtt_port,
+        username=args.source_mqtt_username,
+        password=args.source_mqtt_password,
+        tls=args.source_mqtt_tls,
+    )
+    
     # Create the target MQTT client
-    client_id = f"grobro-target-{random.randint(0,9999)}"
+    client_id = f"grobro-target-{secrets.token_hex(2)}"
     target_client = mqtt.Client(client_id=client_id)
     
-    # Store source MQTT config and other settings in userdata
+    # Store the source MQTT client and other settings in userdata
     userdata = {
-        "source_mqtt": {
-            "broker": args.source_mqtt_broker,
-            "port": args.source_mqtt_port,
-            "username": args.source_mqtt_username,
-            "password": args.source_mqtt_password,
-            "tls": args.source_mqtt_tls
-        },
+        "source_client": source_client,
         "topic": args.topic,
         "hexdump": args.hexdump
     }
@@ -358,6 +410,9 @@ def main():
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
+    finally:
+        source_client.disconnect()
+        source_client.loop_stop()
 
 if __name__ == "__main__":
     main()
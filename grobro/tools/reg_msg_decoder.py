@@ -4,6 +4,7 @@
 # Growatt NOAH/NEO register message decoder
 
 import struct
+import functools
 import argparse
 import pathlib
 import json
@@ -12,31 +13,49 @@ import sys
 import string
 import crc
 
-crc16 = crc.Calculator(crc.Crc16.MODBUS)
+crc16 = crc.Calculator(crc.Crc16.MODBUS, optimized=True)
+CRC = struct.Struct("!H")
+U16 = struct.Struct(">H")
+U16_PAIR = struct.Struct(">HH")
+TLV_HEADER = struct.Struct(">HHH")
+
+@functools.lru_cache(maxsize=64)
+def descramble_mask(length: int) -> int:
+    # "Growatt" repeated to length bytes, as integer
+    mask = b"Growatt"
+    return int.from_bytes((mask * (length // len(mask) + 1))[:length], "big")
 
 def descramble(pkt: bytes) -> bytes:
-    MASK = b"Growatt"
     body, crc_stored = pkt[:-2], pkt[-2:]
-    if not crc16.verify(pkt[:-2], struct.unpack("!H", pkt[-2:])[0]):
+    if not crc16.verify(body, CRC.unpack(crc_stored)[0]):
         print("Warning! CRC mismatch – continuing anyway...", file=sys.stderr)
-    out = bytearray(pkt[:8])
-    out += bytes(b ^ MASK[i % len(MASK)] for i, b in enumerate(pkt[8:-2]))
-    return bytes(out)
+    n = len(body) - 8
+    if n <= 0:
+        return bytes(pkt[:8])
+    # XOR the body with the repeated mask as one big integer
+    plain = int.from_bytes(body[8:], "big") ^ descramble_mask(n)
+    return bytes(body[:8]) + plain.to_bytes(n, "big")
 
-def hexdump(data: bytes, width: int = 16):
+# printable ascii stays, everything else is shown as "."
+HEXDUMP_ASCII = bytes(b if 32 <= b <= 126 else 0x2E for b in range(256))
+
+def hexdump_lines(data: bytes, width: int = 16):
     for i in range(0, len(data), width):
         chunk = data[i:i + width]
-        hex_bytes = ' '.join(f'{b:02X}' for b in chunk)
-        ascii_repr = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
-        print(f"{i:08X}  {hex_bytes:<{width*3}}  |{ascii_repr}|")
+        hex_bytes = chunk.hex(' ').upper()
+        ascii_repr = chunk.translate(HEXDUMP_ASCII).decode('ascii')
+        yield f"{i:08X}  {hex_bytes:<{width*3}}  |{ascii_repr}|"
+
+def hexdump(data: bytes, width: int = 16):
+    for line in hexdump_lines(data, width):
+        print(line)
 
 
 def noah_decode_charge_limit(body: bytes):
     pos = body.find(b"\x00\xFA\x00\xFB")
     if pos == -1 or pos + 8 > len(body):
         return None
-    upper = struct.unpack_from(">H", body, pos + 4)[0]
-    lower = struct.unpack_from(">H", body, pos + 6)[0]
+    upper, lower = U16_PAIR.unpack_from(body, pos + 4)
     return {"action": "charge_limit", "upper": upper, "lower": lower}
 
 def noah_decode_slot(body: bytes):
@@ -52,11 +71,11 @@ def noah_decode_slot(body: bytes):
     if compact:
         slot = body[pos + 1]
         sh, sm, eh, em = body[pos + 4 : pos + 8]
-        power = struct.unpack_from(">H", body, pos + 10)[0]
+        power = U16.unpack_from(body, pos + 10)[0]
     else:
         slot = body[pos + 1]
         sh, sm, eh, em = body[pos + 3 : pos + 7]
-        power = struct.unpack_from(">H", body, pos + 9)[0]
+        power = U16.unpack_from(body, pos + 9)[0]
 
     # TODO: Find out why slot numbers are off
     if (sh, sm, eh, em, power) == (0, 0, 0, 0, 0):
@@ -77,7 +96,7 @@ def noah_decode_output_limit(body: bytes):
     pos = body.find(b"\xFC")
     if pos == -1 or pos + 3 > len(body):
         return None
-    power = struct.unpack(">H", body[pos + 1 : pos + 3])[0]
+    power = U16.unpack_from(body, pos + 1)[0]
     return {"action": "output_limit", "power": power}
 
 def noah_decode_datetime(body: bytes):
@@ -97,20 +116,54 @@ def noah_decode_smartpowerset(body: bytes):
     pos = body.find(b"\x01\x36\x01\x38")
     if pos == -1 or pos + 10 > len(body):
         return None
-    setdown = struct.unpack(">H", body[pos + 4 : pos + 6])[0]
-    setup = struct.unpack(">H", body[pos + 6 : pos + 8])[0]
+    setdown, setup = U16_PAIR.unpack_from(body, pos + 4)
     return {"action": "smart_powerset", "set_power_up": setup, "set_power_down": setdown}
 
-def decode_noah(mtype: int, payload: bytes):
-    body = payload
-    for fn in (
+# Commands carry their marker right after the 14 byte reserved padding.
+# More specific markers come first, "\x01" alone is a compact slot.
+NOAH_MARKER_OFFSET = 14
+NOAH_MARKERS = (
+    (b"\x01\x36\x01\x38", noah_decode_smartpowerset),
+    (b"\x01\x2C", noah_decode_inverter),
+    (b"\x00\xFA\x00\xFB", noah_decode_charge_limit),
+    (b"\x00\xFE", noah_decode_slot),
+    (b"\x00\xFC", noah_decode_output_limit),
+    (b"\x01", noah_decode_slot),
+)
+
+NOAH_ALL_DECODERS = (
+    noah_decode_charge_limit,
+    noah_decode_slot,
+    noah_decode_output_limit,
+    noah_decode_datetime,
+    noah_decode_inverter,
+    noah_decode_smartpowerset,
+)
+# Multiple register writes (0x0110) vs single register writes (0x0106),
+# any other message type still tries every decoder
+NOAH_DECODERS = {
+    0x0110: (
         noah_decode_charge_limit,
         noah_decode_slot,
-        noah_decode_output_limit,
         noah_decode_datetime,
-        noah_decode_inverter,
         noah_decode_smartpowerset,
-    ):
+    ),
+    0x0106: (
+        noah_decode_output_limit,
+        noah_decode_inverter,
+    ),
+}
+
+def decode_noah(mtype: int, payload: bytes):
+    body = payload
+    for marker, fn in NOAH_MARKERS:
+        if body.startswith(marker, NOAH_MARKER_OFFSET):
+            res = fn(body)
+            if res:
+                return res
+            break
+    # Unknown layout, search the whole body
+    for fn in NOAH_DECODERS.get(mtype, NOAH_ALL_DECODERS):
         res = fn(body)
         if res:
             return res
@@ -119,18 +172,23 @@ def decode_noah(mtype: int, payload: bytes):
 # TODO: Merge tlv_parse and decode_register
 def tlv_parse(buf: bytes):
     out, off = [], 0
-    while off + 6 <= len(buf):
-        reg, idk, ln = struct.unpack_from(">HHH", buf, off)
+    # Values are sliced from a view, only decoding copies them
+    view = memoryview(buf)
+    end = len(buf)
+    unpack_header = TLV_HEADER.unpack_from
+    append = out.append
+    while off + 6 <= end:
+        reg, idk, ln = unpack_header(buf, off)
         off += 6
-        if off + ln > len(buf):
+        if off + ln > end:
             break
-        val = buf[off : off + ln]
+        val = view[off : off + ln]
         off += ln
         try:
-            val = val.decode("ascii")
+            val = str(val, "ascii")
         except UnicodeDecodeError:
             val = val.hex()
-        out.append({"register": reg, "value": val})
+        append({"register": reg, "value": val})
     return out
 
 def decode_register(payload: bytes) -> dict | None:
@@ -141,7 +199,7 @@ def decode_register(payload: bytes) -> dict | None:
         val_raw = payload[val_len + 1:]
         try:
             val = val_raw.decode("ascii")
-            if all(ch in "0123456789" for ch in val):
+            if val.isdigit():
                 val = int(val)
         except UnicodeDecodeError:
             val = val_raw.hex()
@@ -164,38 +222,45 @@ def decode_payload(device_id: str,mtype: int, payload: bytes):
        return decode_noah(mtype, payload)
 
 
+def iter_blobs(paths):
+    # Read one file at a time instead of holding all of them in memory
+    for p in paths:
+        yield p, pathlib.Path(p).read_bytes()
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("files", nargs="+")
     ap.add_argument("--hex", action="store_true", help="Output in hex format")
     args = ap.parse_args()
 
-    blobs = []
-    blobs += [(p, pathlib.Path(p).read_bytes()) for p in args.files]
-
-    for name, blob in blobs:
-        print(f"\n=== {name} ===")
-        plain = descramble(blob)
-        if args.hex:
-            hexdump(plain)
-            print()
-
-        msg_len = struct.unpack_from(">H", plain, 4)[0]
-        msg_type = struct.unpack_from(">H", plain, 6)[0]
-        device_id = plain[8:24].decode("ascii", "ignore").rstrip("\x00")
-        payload = plain[24:]
-
-        print(
-            json.dumps(
-                {
-                    "msg_len": msg_len,
-                    "msg_type": msg_type,
-                    "device_id": device_id,
-                    "payload": decode_payload(device_id, msg_type, payload),
-                },
-                indent=2,
+    for name, blob in iter_blobs(args.files):
+        # Collect the whole record and write it at once
+        out = [f"\n=== {name} ==="]
+        try:
+            plain = descramble(blob)
+            if args.hex:
+                out.extend(hexdump_lines(plain))
+                out.append("")
+
+            msg_len, msg_type = U16_PAIR.unpack_from(plain, 4)
+            device_id = plain[8:24].decode("ascii", "ignore").rstrip("\x00")
+            payload = plain[24:]
+
+            out.append(
+                json.dumps(
+                    {
+                        "msg_len": msg_len,
+                        "msg_type": msg_type,
+                        "device_id": device_id,
+                        "payload": decode_payload(device_id, msg_type, payload),
+                    },
+                    indent=2,
+                )
             )
-        )
+        finally:
+            sys.stdout.write("\n".join(out) + "\n")
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
@@ -13,6 +13,7 @@ from grobro.grobro.builder import append_crc
 from grobro.grobro.builder import scramble
 from datetime import datetime
 from grobro.model.modbus_function import GrowattModbusFunctionSingle
+from grobro.model.modbus_function import GrowattModbusFunctionMultiple
 
 TEST_DEVICE_ID = "QMN000ABC1D2E3FG"
 
@@ -53,6 +54,16 @@ TEST_DEVICE_ID = "QMN000ABC1D2E3FG"
             ),
             "NeoReadOutputPowerLimit.bin",
         ),
+        (
+            GrowattModbusFunctionMultiple(
+                device_id=TEST_DEVICE_ID,
+                function=GrowattModbusFunction.PRESET_MULTIPLE_REGISTER,
+                start=3,
+                end=4,
+                values=struct.pack(">HH", 42, 1),
+            ),
+            "NeoPresetMultipleRegister.bin",
+        ),
         (
             GrowattModbusMessage(
                 unknown=106,
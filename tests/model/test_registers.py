@@ -0,0 +1,31 @@
+import struct
+import pytest
+
+from grobro.model.growatt_registers import (
+    GrowattRegisterDataType,
+    GrowattRegisterDataTypes,
+    GrowattRegisterFloatOptions,
+)
+
+
+@pytest.mark.parametrize(
+    ("multiplier", "delta"),
+    [
+        (0.1, 0.0),
+        (0.01, 0.0),
+        (0.001, 0.0),
+        (0.0001, 0.0),
+        (1.0, 0.0),
+        (1.0, -30000.0),
+        (0.1, -30000.0),
+        (3.0, 0.0),
+    ],
+)
+def test_parse_float(multiplier, delta):
+    data_type = GrowattRegisterDataType(
+        data_type=GrowattRegisterDataTypes.FLOAT,
+        float_options=GrowattRegisterFloatOptions(multiplier=multiplier, delta=delta),
+    )
+    for raw_value in range(0, 65536, 7):
+        got = data_type.parse(struct.pack(">H", raw_value))
+        assert got == round(raw_value * multiplier + delta, 3)